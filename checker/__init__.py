@@ -1,3 +1,7 @@
+import sys
+from functools import partial
+
+from scheduler import run_concurrently
 from settings import SETTINGS
 
 
@@ -18,5 +22,20 @@ def triton(config_file_list):
 
 
 def all_(config_file_list):
-    for cloud in SETTINGS.SUPPORTED_CLOUDS:
-        cloud(config_file_list)
+    """
+    Checks configuration of every supported cloud concurrently.
+    :return: dict: with result of check by cloud name
+    """
+    checkers = sys.modules[__name__]
+    results = run_concurrently(
+        [
+            (cloud, partial(getattr(checkers, cloud), config_file_list))
+            for cloud in SETTINGS.SUPPORTED_CLOUDS
+        ],
+        len(SETTINGS.SUPPORTED_CLOUDS),
+        thread_name_prefix="check",
+    )
+    for task_result in results:
+        if task_result.error is not None:
+            raise task_result.error
+    return {task_result.name: task_result.result for task_result in results}
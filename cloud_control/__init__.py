@@ -1,10 +1,17 @@
 import argparse
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime
+from functools import partial
 
 import common
+from common import rate_limit
 import reporter.local
+from reporter import tracing
 
-from deployer import deploy
+from deployer import deploy, NO_CHANGES
+from scheduler import run_concurrently, format_summary
 
 # from checker import check
 from code_control import setup, BranchProtectArgAction
@@ -12,10 +19,25 @@ from code_control import setup, BranchProtectArgAction
 from settings import SETTINGS
 
 
+# files and hashes of code and config repos are fetched at the same time
+FETCH_WORKERS = 4
+
+
 class CloudControlException(Exception):
     pass
 
 
+def _testing_ending(config_hash, code_hash, project_id):
+    """
+    Ending of name of test project. Projects deployed with the same code and
+    config at the same time get own test deployments, since digest of
+    project id is included. Project id of test project, like
+    `testing-<config>-<code>-<project>`, fits in 30 characters allowed by GCP.
+    """
+    project_digest = hashlib.sha256(project_id.encode()).hexdigest()
+    return f"{config_hash[:7]}-{code_hash[:7]}-{project_digest[:6]}"
+
+
 class ArgumentsParser:
     """
     That class used for subparsers setup, and storing all parsed arguments.
@@ -33,7 +55,9 @@ class ArgumentsParser:
 
         self.args = self.root_parser.parse_args(args)
 
-        if not self.args.config_repo:
+        # queued projects use their own config repos
+        queued = getattr(self.args, "projects_list", None)
+        if not self.args.config_repo and not queued:
             self.args.config_repo = self.args.project_id
 
     def _setup_deploy_parser(self):
@@ -61,6 +85,13 @@ class ArgumentsParser:
             "repository as well to maintain consistent naming but if "
             "you need to call it something else, use this argument",
         )
+        deploy_parser.add_argument(
+            "--revalidate",
+            help="Forget previous validation of code and config commits and "
+            "validate them with test deployment again",
+            default=False,
+            action="store_true",
+        )
 
     def _setup_config_parser(self):
         """
@@ -74,6 +105,7 @@ class ArgumentsParser:
             change_files=SETTINGS.LOCAL_FILES,
             branch_permissions=SETTINGS.PROTECTED_BRANCH,
             force=False,
+            plan=False,
         )
         config_parser.formatter_class = argparse.RawTextHelpFormatter
         config_parser.add_argument("--github")
@@ -107,6 +139,13 @@ class ArgumentsParser:
             default=False,
             action="store_true",
         )
+        config_parser.add_argument(
+            "--plan",
+            help="Print changes of repository, teams and branch protection"
+            " without applying them",
+            default=False,
+            action="store_true",
+        )
         config_parser.add_argument(
             "-f",
             "--force",
@@ -123,9 +162,10 @@ class CloudControl:
 
     def __init__(self, args):
         self.args = args
+        self._start_time = datetime.utcnow()
 
         self._setup_logger()
-        self._setup_app_metrics()
+        self._setup_tracing()
 
     def _setup_logger(self):
         self._log = reporter.local.get_logger(
@@ -133,6 +173,12 @@ class CloudControl:
         )
 
     def _setup_app_metrics(self):
+        """
+        Metrics client is created only when metrics are sent, since google
+        cloud libraries are slow to import.
+        """
+        import reporter.stackdriver
+
         if getattr(self.args, "key_file", None):
             auth = common.GcpAuth(self.args.key_file)
         else:
@@ -144,33 +190,96 @@ class CloudControl:
             metrics_set_list=[],
         )
 
+    def _setup_tracing(self):
+        self._spans = (
+            tracing.enable(self._log) if SETTINGS.TRACING_ENABLED else None
+        )
+
+    @staticmethod
+    def _result_label(command_result):
+        """
+        Commands return either bool, or string with outcome, like "no_changes"
+        """
+        if isinstance(command_result, str):
+            return command_result
+        return "success" if command_result else "failure"
+
+    def _log_github_cache_stats(self):
+        response_cache = common.http_cache.get_response_cache()
+        blob_cache = common.blobs.get_blob_cache()
+        if response_cache:
+            self._log.info(f"GitHub responses cache: {response_cache.stats}")
+        if blob_cache:
+            self._log.info(f"GitHub blobs cache: {blob_cache.stats}")
+        self._log.info(f"GitHub requests: {rate_limit.get_stats()}")
+
+    def _github_requests_metrics(self):
+        stats = rate_limit.get_stats()
+        labels = {"command": self.args.command}
+        return [
+            {
+                "metric_name": "github_requests",
+                "labels": labels,
+                "metric_kind": "gauge",
+                "value_type": "int64",
+                "value": stats["requests"],
+            },
+            {
+                "metric_name": "github_rate_limit_retries",
+                "labels": labels,
+                "metric_kind": "gauge",
+                "value_type": "int64",
+                "value": stats["retries"],
+            },
+            {
+                "metric_name": "github_rate_limit_wait_time",
+                "labels": labels,
+                "metric_kind": "gauge",
+                "value_type": "double",
+                "value": stats["wait_time"],
+            },
+            {
+                "metric_name": "github_requests_throughput",
+                "labels": labels,
+                "metric_kind": "gauge",
+                "value_type": "double",
+                "value": stats["throughput"],
+            },
+        ]
+
     def _log_and_send_metrics(self, command, command_result):
         self._log.info("finished " + command + " run")
+        self._log_github_cache_stats()
+        self._setup_app_metrics()
+        self._app_metrics.start_time = self._start_time
         self._app_metrics.end_time = datetime.utcnow()
+        result = self._result_label(command_result)
 
         self._app_metrics.metrics_set_list = [
             {
                 "metric_name": "deployment_time",
-                "labels": {
-                    "result": "success" if command_result else "failure",
-                    "command": self.args.command,
-                },
+                "labels": {"result": result, "command": self.args.command},
                 "metric_kind": "gauge",
                 "value_type": "double",
                 "value": self._app_metrics.app_runtime.total_seconds(),
             },
             {
                 "metric_name": "deployments_rate",
-                "labels": {
-                    "result": "success" if command_result else "failure",
-                    "command": self.args.command,
-                },
+                "labels": {"result": result, "command": self.args.command},
                 "metric_kind": "cumulative",
                 "value_type": "int64",
                 "value": 1,
                 "unit": "h",
             },
+            *self._github_requests_metrics(),
         ]
+        if self._spans:
+            for metrics_set in self._spans.metrics(
+                max_depth=SETTINGS.TRACING_METRICS_DEPTH,
+                aggregated_labels=SETTINGS.TRACING_METRICS_AGGREGATED_LABELS,
+            ):
+                metrics_set["labels"]["command"] = self.args.command
+                self._app_metrics.add_metric_set(metrics_set)
         self._app_metrics.send_metrics()
 
     def perform_command(self):
@@ -195,36 +304,181 @@ class CloudControl:
             self._log_and_send_metrics(self.args.command, result)
 
     def _deploy(self):
-        self._log.info("Starting deployment")
-        if self.args.cloud == "all":
-            self.args.cloud = "all_"
-        config_org = common.get_org(self.args, self.args.config_org)
-        code_org = common.get_org(self.args, self.args.code_org)
-        config_files = common.get_files(
-            config_org,
-            self.args.config_repo,
-            self.args.cloud,
-            self.args.config_version,
-        )
-        # code repo should contain any lists or maps that define
-        # security policies
-        # and operating requirements. The code repo should be public.
-        code_files = common.get_files(
-            code_org,
-            self.args.code_repo,
-            self.args.cloud,
-            self.args.config_version,
+        deployments = self._deployments_args()
+        if len(deployments) == 1:
+            _, args = deployments[0]
+            return self._deploy_project(args)
+        return self._run_concurrently(
+            [
+                (name, partial(self._deploy_project, args))
+                for name, args in deployments
+            ]
         )
 
-        config_hash = common.get_hash_of_latest_commit(
-            config_org, self.args.config_repo, self.args.config_version
+    def _deployments_args(self):
+        """
+        Splits deployment into independent deployments: one for every queued
+        project, and for every supported cloud, if all clouds are deployed.
+        Every deployment gets own copy of arguments, so it's deployed by own
+        deployer in own working directory.
+        :return: list: of (name, arguments) tuples
+        """
+        projects = getattr(self.args, "projects_list", None)
+        if projects:
+            projects_args = [
+                (project_id, self._project_args(project_id))
+                for project_id in projects
+            ]
+        else:
+            projects_args = [(self.args.project_id, self.args)]
+
+        if self.args.cloud != "all":
+            return projects_args
+
+        deployments = []
+        for project_id, project_args in projects_args:
+            for cloud in SETTINGS.SUPPORTED_CLOUDS:
+                cloud_args = copy(project_args)
+                cloud_args.cloud = cloud
+                deployments.append((f"{project_id}/{cloud}", cloud_args))
+        return deployments
+
+    def _project_args(self, project_id):
+        """
+        Copy of arguments for one of queued projects.
+        """
+        args = copy(self.args)
+        args.project_id = project_id
+        args.config_repo = self.args.config_repo or project_id
+        return args
+
+    def _run_concurrently(self, tasks):
+        """
+        Runs tasks concurrently, with number of workers limited by --workers
+        argument, and reports their results in one summary.
+        :param tasks: list: of (name, callable) tuples
+        :return: False if some task failed, NO_CHANGES if nothing changed for
+         all of them, True otherwise
+        """
+        results = run_concurrently(
+            tasks, self.args.workers, thread_name_prefix=self.args.command
         )
-        code_hash = common.get_hash_of_latest_commit(
-            code_org, self.args.code_repo, self.args.code_version
+
+        summary = format_summary(results, self._result_label)
+        self._log.info(f"results of {self.args.command}:\n" + summary)
+        print(summary)
+
+        if any(task_result.error for task_result in results):
+            return False
+        if all(task_result.result == NO_CHANGES for task_result in results):
+            return NO_CHANGES
+        return True
+
+    def _deploy_project(self, args):
+        self._log.info(
+            f"Starting deployment of {args.project_id} to {args.cloud}"
         )
-        testing_ending = f"{config_hash[:7]}-{code_hash[:7]}"
+        # projects get fair shares of GitHub requests
+        with tracing.span("deploy", project=args.project_id, cloud=args.cloud):
+            with rate_limit.share(args.project_id):
+                return self._fetch_and_deploy(args)
 
-        return deploy(self.args, code_files, config_files, testing_ending)
+    def _fetch_and_deploy(self, args):
+        """
+        Files and commit hashes of both repos are fetched concurrently, and
+        passed to deploy as futures, so real deployment starts initialising
+        terraform as soon as files arrive, while the rest is still fetched.
+        """
+        config_org = common.get_org(args, args.config_org)
+        code_org = common.get_org(args, args.code_org)
+
+        with ThreadPoolExecutor(
+            max_workers=FETCH_WORKERS, thread_name_prefix="fetch"
+        ) as executor:
+
+            def fetch(function, *function_args):
+                function = rate_limit.propagate(function)
+                return executor.submit(
+                    tracing.propagate(function), *function_args
+                )
+
+            config_files = fetch(
+                common.get_files,
+                config_org,
+                args.config_repo,
+                args.cloud,
+                args.config_version,
+            )
+            # code repo should contain any lists or maps that define
+            # security policies
+            # and operating requirements. The code repo should be public.
+            code_files = fetch(
+                common.get_files,
+                code_org,
+                args.code_repo,
+                args.cloud,
+                args.code_version,
+            )
+            config_hash = fetch(
+                common.get_hash_of_latest_commit,
+                config_org,
+                args.config_repo,
+                args.config_version,
+            )
+            code_hash = fetch(
+                common.get_hash_of_latest_commit,
+                code_org,
+                args.code_repo,
+                args.code_version,
+            )
+            testing_ending = fetch(
+                lambda: _testing_ending(
+                    config_hash.result(), code_hash.result(), args.project_id
+                )
+            )
+
+            return deploy(
+                args,
+                code_files,
+                config_files,
+                testing_ending,
+                code_hash,
+                config_hash,
+            )
 
     def _config(self):
-        return setup(self.args)
+        """
+        Configures queued projects concurrently, sharing GitHub clients with
+        memoised organisation and teams, or the single project.
+        """
+        projects = getattr(self.args, "projects_list", None)
+        if not projects:
+            return self._config_project(self.args)
+        return self._run_concurrently(
+            [
+                (
+                    project_id,
+                    partial(
+                        self._config_queued_project,
+                        self._project_args(project_id),
+                    ),
+                )
+                for project_id in projects
+            ]
+        )
+
+    def _config_queued_project(self, args):
+        common.valid_project_id_format(args.project_id)
+        try:
+            return self._config_project(args)
+        except SystemExit as e:
+            # setup exits, when repository exists and --force isn't passed,
+            # that shouldn't stop other projects
+            raise CloudControlException(
+                f"configuration of {args.project_id} exited with code {e.code}"
+            )
+
+    def _config_project(self, args):
+        with tracing.span("config", project=args.project_id):
+            with rate_limit.share(args.project_id):
+                return setup(args)
@@ -1,13 +1,24 @@
 import argparse
 import json
 import os
-import requests
-
-# github package is PyGithub
-# noinspection PyPackageRequirements
-from github import GithubException, BadCredentialsException
-from common import get_team, get_repo, get_org
-
+import posixpath
+import threading
+from collections import namedtuple
+from functools import partial
+from pathlib import Path
+
+from common import (
+    forget_team,
+    get_team,
+    get_team_by_id,
+    get_repo,
+    get_org,
+    index_team,
+)
+from common import rate_limit
+from common.cache import git_blob_digest
+
+from reporter import tracing
 from settings import SETTINGS
 
 
@@ -43,6 +54,7 @@ def __get_default_config_file(repo, remote_file):
     return repo.get_contents(remote_file, ref="master")
 
 
+@tracing.traced("create_repo")
 def create_repo(org, name=SETTINGS.DEFAULT_PROJECT_ID):
     """
     creates the GitHub repository
@@ -59,66 +71,132 @@ class GithubFileExists(Exception):
     pass
 
 
-def update_repo_file(
-    repo,
-    file_to_change,
-    new_content,
-    commit_msg,
-    force=False,
-    bypass_protection=False,
+def _content_changed(sha, new_content):
+    """
+    Compares git blob sha of file in repository with sha of new content, so
+    unchanged files aren't committed again.
+    """
+    return git_blob_digest(new_content.encode()) != sha
+
+
+def _list_files(repo, tree_sha, paths):
+    """
+    Lists files of git tree, usually by one request. GitHub truncates
+    recursive listing of large trees, then only subtrees, which could
+    contain given paths, are listed one by one.
+    :param paths: iterable: of paths of files, which are looked up
+    :return: dict: of git blob sha of files by their paths
+    """
+    tree = repo.get_git_tree(tree_sha, recursive=True)
+    if not tree.raw_data.get("truncated"):
+        return {element.path: element.sha for element in tree.tree}
+
+    directories = {posixpath.dirname(path) for path in paths}
+    files = {}
+    subtrees = [(tree_sha, "")]
+    while subtrees:
+        sha, prefix = subtrees.pop()
+        for element in repo.get_git_tree(sha).tree:
+            path = prefix + element.path
+            if element.type != "tree":
+                files[path] = element.sha
+            elif any(
+                directory == path or directory.startswith(path + "/")
+                for directory in directories
+            ):
+                subtrees.append((element.sha, path + "/"))
+    return files
+
+
+@tracing.traced("update_repo_files")
+def update_repo_files(
+    repo, files, commit_msg, force=False, bypass_protection=False, plan=False
 ):
     """
-    Updates the files on the newly project repository
-    :param bypass_protection: bool:  whether to bypass protection on branch
-    :param force: bool: whether or not to force an update to an existing file
+    Updates files on master branch of repository by one commit, which is
+    created through git data API: the tree with new contents of all files is
+    created on top of the tree of the last commit, so number of requests
+    doesn't depend on number of files. Files, which content didn't change,
+    are left out, and nothing is committed, if none of them changed
     :param repo: obj: repository we're modifying
-    :param file_to_change: str: of the path relative to the file in the repo
-    :param new_content: str: to write to the file in Github
+    :param files: dict: of contents of files by their paths in the repo
     :param commit_msg: str: message to go with the git commit
+    :param force: bool: whether or not to force an update to existing files
+    :param bypass_protection: bool:  whether to bypass protection on branch
+    :param plan: bool: whether to only find files, which would be changed
+    :return: list: of paths of changed files
     """
+    # github package is PyGithub
+    # noinspection PyPackageRequirements
+    from github import GithubException, InputGitTreeElement
+
+    if not files:
+        return []
     try:
-        cur_file = repo.get_contents(file_to_change, ref="master")
+        ref = repo.get_git_ref("heads/master")
     except GithubException as e:
-        cur_file = None
-        print(e.data)
-        print(file_to_change + " doesn't exist. Creating...")
-
-    if cur_file and force is True:
-        print("Updating file " + file_to_change)
-        try:
-            repo.update_file(
-                cur_file.path,
-                commit_msg + file_to_change,
-                new_content,
-                cur_file.sha,
-                branch="master",
-            )
-        except GithubException as e:
-            if e.status == 409 and bypass_protection:
-                set_master_branch_permissions(repo, {})
-                update_repo_file(
-                    repo,
-                    file_to_change,
-                    new_content,
-                    commit_msg,
-                    force,
-                    bypass_protection,
-                )
-            else:
-                print(e.data)
-                print("Try --bypass-branch-protection")
-    elif cur_file and force is not True:
-        raise GithubFileExists(
-            "File "
-            + file_to_change
-            + " already exists. Use --force to reconfigure"
-        )
+        if e.status not in (404, 409):
+            raise
+        if plan:
+            return list(files)
+        # git data API doesn't work with empty repository, so it's
+        # initialised by the first file
+        (first_file, content), *rest = files.items()
+        print("Creating " + first_file)
+        repo.create_file(first_file, commit_msg, content, branch="master")
+        created_files = [first_file]
+        files = dict(rest)
+        if not files:
+            return created_files
+        ref = repo.get_git_ref("heads/master")
     else:
-        repo.create_file(
-            file_to_change, commit_msg, new_content, branch="master"
-        )
+        created_files = []
+
+    base_commit = repo.get_git_commit(ref.object.sha)
+    existing_files = _list_files(repo, base_commit.tree.sha, files)
+    if not force:
+        for file_to_change in files:
+            if file_to_change in existing_files:
+                raise GithubFileExists(
+                    "File "
+                    + file_to_change
+                    + " already exists. Use --force to reconfigure"
+                )
 
+    changed_files = {
+        path: content
+        for path, content in files.items()
+        if _content_changed(existing_files.get(path), content)
+    }
+    if plan or not changed_files:
+        return created_files + list(changed_files)
+    if any(path in existing_files for path in changed_files):
+        commit_msg += ", ".join(changed_files)
+
+    tree = repo.create_git_tree(
+        [
+            InputGitTreeElement(path, "100644", "blob", content=content)
+            for path, content in changed_files.items()
+        ],
+        base_commit.tree,
+    )
+    commit = repo.create_git_commit(commit_msg, tree, [base_commit])
+    print("Updating files " + ", ".join(changed_files))
+    try:
+        ref.edit(commit.sha)
+    except GithubException as e:
+        # protected branch rejects commits pushed directly
+        if e.status in (409, 422) and bypass_protection:
+            set_master_branch_permissions(repo, {})
+            ref.edit(commit.sha)
+        else:
+            print(e.data)
+            print("Try --bypass-branch-protection")
+            return created_files
+    return created_files + list(changed_files)
 
+
+@tracing.traced("create_team")
 def create_team(
     org,
     team_name=SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"],
@@ -138,13 +216,16 @@ def create_team(
         existing_team.edit(
             name=team_name, permission=permission, privacy=privacy
         )
-        return existing_team
-
-    return org.create_team(
-        name=team_name, permission=permission, privacy=privacy
-    )
+        team = existing_team
+    else:
+        team = org.create_team(
+            name=team_name, permission=permission, privacy=privacy
+        )
+    index_team(org, team, team_name)
+    return team
 
 
+@tracing.traced("configure_remote_object")
 def configure_remote_object(url, token, **kwargs):
     """
     uses request module to pass headers needed for beta API feature of setting
@@ -160,7 +241,9 @@ def configure_remote_object(url, token, **kwargs):
         "Authorization": "token " + token,
     }
 
-    response = requests.patch(url=url, headers=headers, data=json.dumps(data))
+    response = rate_limit.request(
+        "PATCH", url, headers=headers, data=json.dumps(data)
+    )
     if response.status_code != 200:
         print("ERROR: FAILED TO UPDATE OBJECT")
         print(response.headers)
@@ -185,18 +268,24 @@ def configure_project_data(config_file, **kwargs):
 
 
 def write_project_data(repo, teams, data_dir=SETTINGS.PROJECT_DATA_DIR):
-    if not os.path.isdir(data_dir):
-        os.mkdir(data_dir, 0o0700)
+    """
+    Writes data of repository and its teams to subdirectory of `data_dir`
+    named after repository, so concurrently configured projects don't
+    overwrite data of each other.
+    """
+    project_dir = Path(data_dir) / repo.name
+    os.makedirs(project_dir, 0o0700, exist_ok=True)
 
-    repo_file = data_dir + "/repo.json"
+    repo_file = project_dir / "repo.json"
     with open(repo_file, "w") as rf:
         rf.write(json.dumps(repo.raw_data, indent=2))
     for team in teams:
-        team_file = data_dir + "/team_" + team.slug + ".json"
+        team_file = project_dir / ("team_" + team.slug + ".json")
         with open(team_file, "w") as tf:
             tf.write(json.dumps(team.raw_data, indent=2))
 
 
+@tracing.traced("set_repo_visibility")
 def set_repo_visibility(repo, visibility):
     """
     Sets whether the repository can be seen publicly or not
@@ -211,6 +300,7 @@ def set_repo_visibility(repo, visibility):
         raise ValueError
 
 
+@tracing.traced("set_repo_team_perms")
 def set_repo_team_perms(org, repo, team_id, permission):
     """
     Sets the permissions of a team on a repository
@@ -219,7 +309,7 @@ def set_repo_team_perms(org, repo, team_id, permission):
     :param team_id: int: the ID of the team that is gaining access
     :param permission: str: one of read (pull), write (push) or admin (admin)
     """
-    team = org.get_team(team_id)
+    team = get_team_by_id(org, team_id)
     if permission == "read":
         team.set_repo_permission(repo, "pull")
     elif permission == "write":
@@ -228,6 +318,7 @@ def set_repo_team_perms(org, repo, team_id, permission):
         team.set_repo_permission(repo, permission)
 
 
+@tracing.traced("set_master_branch_permissions")
 def set_master_branch_permissions(repo, branch_permissions):
     """
     set relevant protections on the master branch as described in
@@ -247,7 +338,242 @@ def __file_content(file_with_content):
         return content.read()
 
 
+# change of remote object, which brings it to desired state
+Change = namedtuple(
+    "Change", ["resource", "attribute", "current", "desired", "apply"]
+)
+
+
+def format_change(change):
+    return (
+        f"{change.resource}: {change.attribute}: "
+        f"{change.current!r} -> {change.desired!r}"
+    )
+
+
+_teams_lock = threading.Lock()
+
+
+def plan_changes(org, repo, parsed_args):
+    """
+    Compares current state of project teams, repository and protection of
+    its master branch with desired state, which is built from settings and
+    arguments. Current state is only read, so it's served from cache of
+    GitHub responses, if nothing changed.
+    :param org: obj: organisation of the repository and teams
+    :param repo: obj: repository, or None if it doesn't exist yet
+    :param parsed_args: object: with vcs_token and branch_permissions
+    :return: list: of :class:`Change`, to be applied in order
+    """
+    return [
+        *plan_team_changes(org, parsed_args.vcs_token),
+        *_repo_changes(org, repo, parsed_args.branch_permissions),
+    ]
+
+
+def plan_team_changes(org, token):
+    """
+    Changes of teams, which are shared by all projects.
+    :return: list: of :class:`Change`
+    """
+    std_team = SETTINGS.STANDARD_TEAM_ATTRIBUTES
+    # nested teams can't be secret, so privileged team is kept closed, like
+    # the standard one
+    priv_team = dict(SETTINGS.PRIV_TEAM_ATTRIBUTES, privacy=std_team["privacy"])
+    return [
+        *_team_changes(org, std_team, token),
+        *_team_changes(org, priv_team, token, parent=std_team["name"]),
+    ]
+
+
+def _team_changes(org, attributes, token, parent=None):
+    name = attributes["name"]
+    resource = "team " + name
+    team = get_team(org, name)
+    if team is None:
+        current = {}
+        changes = [
+            Change(
+                resource,
+                "exists",
+                False,
+                True,
+                partial(
+                    create_team,
+                    org,
+                    name,
+                    attributes["permission"],
+                    attributes["privacy"],
+                ),
+            )
+        ]
+    else:
+        current = {
+            "permission": team.permission,
+            "privacy": team.privacy,
+            "description": team.description,
+            "parent": team.parent.slug if team.parent else None,
+        }
+        changes = []
+
+    for attribute in ("permission", "privacy", "description"):
+        if team is not None or attribute == "description":
+            if current.get(attribute) != attributes[attribute]:
+                changes.append(
+                    Change(
+                        resource,
+                        attribute,
+                        current.get(attribute),
+                        attributes[attribute],
+                        partial(
+                            _configure_team,
+                            org,
+                            name,
+                            token,
+                            **{attribute: attributes[attribute]},
+                        ),
+                    )
+                )
+    if parent and current.get("parent") != parent:
+        changes.append(
+            Change(
+                resource,
+                "parent",
+                current.get("parent"),
+                parent,
+                partial(_set_team_parent, org, name, parent, token),
+            )
+        )
+    return changes
+
+
+def _repo_changes(org, repo, branch_permissions):
+    changes = []
+    private = repo.private if repo else None
+    if private is not True:
+        changes.append(
+            Change(
+                "repository",
+                "private",
+                private,
+                True,
+                partial(_make_repo_private, repo),
+            )
+        )
+
+    desired_permissions = {
+        SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"]: "pull",
+        SETTINGS.PRIV_TEAM_ATTRIBUTES["name"]: "push",
+    }
+    if get_team(org, SETTINGS.ADMIN_TEAM):
+        desired_permissions[SETTINGS.ADMIN_TEAM] = "admin"
+    # one listing of teams of repository covers all of them
+    current_permissions = (
+        {team.slug: team.permission for team in repo.get_teams()}
+        if repo
+        else {}
+    )
+    for slug, permission in desired_permissions.items():
+        if current_permissions.get(slug) != permission:
+            changes.append(
+                Change(
+                    "repository team " + slug,
+                    "permission",
+                    current_permissions.get(slug),
+                    permission,
+                    partial(_set_team_permission, org, repo, slug, permission),
+                )
+            )
+
+    desired_protection = dict(branch_permissions or {})
+    current_protection = _master_branch_protection(repo) if repo else {}
+    if desired_protection:
+        current_protection = {
+            key: current_protection.get(key) for key in desired_protection
+        }
+    if current_protection != desired_protection:
+        changes.append(
+            Change(
+                "branch master",
+                "protection",
+                current_protection,
+                desired_protection,
+                partial(
+                    set_master_branch_permissions, repo, desired_protection
+                ),
+            )
+        )
+    return changes
+
+
+def _master_branch_protection(repo):
+    """
+    :return: dict: with keys of settings of branch protection, empty if
+     branch isn't protected
+    """
+    # noinspection PyPackageRequirements
+    from github import GithubException
+
+    try:
+        protection = repo.get_branch("master").get_protection()
+    except GithubException as e:
+        # branch doesn't exist, or isn't protected
+        if e.status == 404:
+            return {}
+        raise
+
+    current = {"enforce_admins": protection.enforce_admins}
+    reviews = protection.required_pull_request_reviews
+    if reviews:
+        current.update(
+            dismiss_stale_reviews=reviews.dismiss_stale_reviews,
+            require_code_owner_reviews=reviews.require_code_owner_reviews,
+            required_approving_review_count=(
+                reviews.required_approving_review_count
+            ),
+        )
+    return current
+
+
+# teams are looked up when changes are applied, since they could be created
+# by previous changes
+
+
+def _apply(changes):
+    for change in changes:
+        print(format_change(change))
+        change.apply()
+    return changes
+
+
+def _configure_team(org, name, token, **attributes):
+    configure_remote_object(get_team(org, name).url, token, **attributes)
+    # memoised team has outdated attributes now
+    forget_team(org, name)
+
+
+def _set_team_parent(org, name, parent, token):
+    _configure_team(org, name, token, parent_team_id=get_team(org, parent).id)
+
+
+def _set_team_permission(org, repo, slug, permission):
+    set_repo_team_perms(org, repo, get_team(org, slug).id, permission)
+
+
+def _make_repo_private(repo):
+    # noinspection PyPackageRequirements
+    from github import GithubException
+
+    try:
+        set_repo_visibility(repo, "private")
+    except GithubException as e:
+        print(e.data)
+
+
 def setup(parsed_args):
+    # noinspection PyPackageRequirements
+    from github import GithubException, BadCredentialsException
+
     # grab the last field from delimited project name
     environment = parsed_args.project_id.upper().split("-").pop()
     try:
@@ -268,21 +594,26 @@ def setup(parsed_args):
         else:
             raise
 
-    if existing_repo and not parsed_args.force:
+    plan = parsed_args.plan
+    if existing_repo and not parsed_args.force and not plan:
         print(
             "Repository "
             + parsed_args.config_repo
             + " already exists. Use --force to reconfigure"
         )
         exit(1)
-    elif existing_repo and parsed_args.force:
+    elif existing_repo:
         repo = existing_repo
         commit_msg = "Update "
+    elif plan:
+        print(format_change(Change("repository", "exists", False, True, None)))
+        repo = None
     else:
         repo = create_repo(org, name=parsed_args.config_repo)
         commit_msg = "Initial commit"
 
     # Configure project
+    files = {}
     for config_file in parsed_args.change_files.keys():
         if config_file == "project_settings_file":
             config = configure_project_data(
@@ -292,53 +623,54 @@ def setup(parsed_args):
             )
         else:
             config = __file_content(parsed_args.change_files[config_file])
-        # Todo: capture update_repo_content exception and exclude if --force is
-        #  set
+        files[SETTINGS.REMOTE_FILES[config_file]] = config
+
+    if plan:
+        changed_files = (
+            update_repo_files(repo, files, "", force=True, plan=True)
+            if repo
+            else list(files)
+        )
+    else:
+        # Todo: capture update_repo_content exception and exclude if --force
+        #  is set
         try:
-            # noinspection PyUnboundLocalVariable
-            update_repo_file(
+            changed_files = update_repo_files(
                 repo,
-                SETTINGS.REMOTE_FILES[config_file],
-                config,
+                files,
                 commit_msg,
                 parsed_args.force,
                 parsed_args.bypass_branch_protection,
             )
         except GithubException as e:
             print(e.data)
-
-    # Create teams
-    std_team = create_team(org)
-    priv_team = create_team(
-        org,
-        SETTINGS.PRIV_TEAM_ATTRIBUTES["name"],
-        SETTINGS.PRIV_TEAM_ATTRIBUTES["permission"],
-    )
-    admin_team = get_team(org, SETTINGS.ADMIN_TEAM)
-    configure_remote_object(
-        std_team.url,
-        parsed_args.vcs_token,
-        description=SETTINGS.STANDARD_TEAM_ATTRIBUTES["description"],
-    )
-    configure_remote_object(
-        priv_team.url,
-        parsed_args.vcs_token,
-        parent_team_id=std_team.id,
-        description=SETTINGS.PRIV_TEAM_ATTRIBUTES["description"],
-    )
-
-    # Set repository permission
-    if admin_team:
-        set_repo_team_perms(org, repo, admin_team.id, "admin")
-    set_repo_team_perms(org, repo, std_team.id, "read")
-    set_repo_team_perms(org, repo, priv_team.id, "write")
-    try:
-        set_repo_visibility(repo, "private")
-    except GithubException as e:
-        print(e.data)
-
-    set_master_branch_permissions(repo, parsed_args.branch_permissions)
-    if parsed_args.output_data:
-        write_project_data(repo, [std_team, priv_team])
+            changed_files = []
+    for changed_file in changed_files:
+        print(f"file {changed_file}: {'planned' if plan else 'updated'}")
+
+    # Reconcile teams, repository permissions and branch protection, only
+    # what differs from desired state is changed
+    if plan:
+        changes = plan_changes(org, repo, parsed_args)
+        for change in changes:
+            print(format_change(change))
+    else:
+        # teams are shared by projects, which are configured concurrently
+        with _teams_lock:
+            changes = _apply(plan_team_changes(org, parsed_args.vcs_token))
+        changes += _apply(
+            _repo_changes(org, repo, parsed_args.branch_permissions)
+        )
+    if not changes and not changed_files:
+        print("No changes")
+
+    if parsed_args.output_data and not plan:
+        write_project_data(
+            repo,
+            [
+                get_team(org, SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"]),
+                get_team(org, SETTINGS.PRIV_TEAM_ATTRIBUTES["name"]),
+            ],
+        )
 
     return True
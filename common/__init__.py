@@ -2,12 +2,19 @@ import re
 import argparse
 import os
 import json
+import sqlite3
+from collections import OrderedDict
+from contextlib import closing
 
-from github import Github
-from httplib2 import Http
-
+from reporter import tracing
 from settings import SETTINGS
 
+from . import http_cache, rate_limit
+from .archive import fetch_directory
+from .blobs import fetch_directory_cached, get_blob_cache
+from .mirror import get_mirror
+from .clients import fetch_team_by_slug, find_github_client, get_github_client
+
 
 class ProjectIdFormatError(Exception):
     pass
@@ -59,9 +66,17 @@ def root_parser():
     group.add_argument(
         "-q",
         "--queued-projects",
-        help="fetch a list of projects from requests queue",
+        help="fetch a list of projects from requests queue: text file with"
+        " project id per line, or SQLite database",
         action=QueuedProjectsArgAction,
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of queued projects processed concurrently",
+        type=int,
+        default=SETTINGS.DEFAULT_WORKERS,
+    )
     parser.add_argument(
         "-t", "--vcs-token", help="Authentication for VCS platform"
     )
@@ -130,6 +145,8 @@ class GcpAuth:
         Add credentials to an HTTP request object
         :return: HTTP request object with added credential information
         """
+        from httplib2 import Http
+
         credentials = self.get_gcp_credentials()
         return credentials.authorize(Http())
 
@@ -164,68 +181,159 @@ class GcpAuth:
 
 
 class QueuedProjectsArgAction(argparse.Action):
+    """
+    Reads list of projects from queue, which is either SQLite database with
+    table of projects, or text file with project id per line.
+    """
+
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
         if nargs is not None:
             raise ValueError("nargs not allowed")
         super(QueuedProjectsArgAction, self).__init__(
-            option_strings, dest, nargs=0, **kwargs
+            option_strings, dest, **kwargs
         )
 
     def __call__(self, parser, namespace, values, option_string=None):
         # ToDo: add function call to get projects list from JIRA
-        setattr(namespace, "projects_list", [])
+        setattr(namespace, self.dest, values)
+        setattr(namespace, "projects_list", read_projects_queue(values))
+
+
+def read_projects_queue(path):
+    """
+    :param path: string: path to queue file, files with extension from
+     SETTINGS.SQLITE_EXTENSIONS are read as SQLite databases
+    :return: list: of unique project ids, in order of queue
+    """
+    if os.path.splitext(path)[-1].lower() in SETTINGS.SQLITE_EXTENSIONS:
+        with closing(sqlite3.connect(path)) as db:
+            rows = db.execute(
+                f"SELECT project_id FROM {SETTINGS.PROJECTS_QUEUE_TABLE}"
+            ).fetchall()
+        projects = [row[0] for row in rows]
+    else:
+        with open(path) as queue_file:
+            projects = [
+                line.strip()
+                for line in queue_file
+                if line.strip() and not line.startswith("#")
+            ]
+    return list(OrderedDict.fromkeys(projects))
 
 
 def get_org(parsed_args, org):
-    github = Github(
-        base_url=parsed_args.api_url, login_or_token=parsed_args.vcs_token
-    )
-    return github.get_organization(org)
+    """
+    Organisation fetched by client shared by commands with the same API URL
+    and token.
+    """
+    client = get_github_client(parsed_args.api_url, parsed_args.vcs_token)
+    return client.get_org(org)
 
 
 def get_repo(org, name=SETTINGS.DEFAULT_PROJECT_ID):
-    return org.get_repo(name)
+    """
+    Repository is memoised by client, which fetched organisation.
+    """
+    client = find_github_client(org)
+    if client is None:
+        return org.get_repo(name)
+    return client.get_repo(org, name)
 
 
 def get_team(org, team_name):
     """
-    returns team from org by searching the name
+    returns team from org by its slug, team is memoised by client, which
+    fetched organisation
     :param org: obj: of the organisation to search
-    :param team_name: string: name of the team to return
-    :return: obj: github.Team.Team
+    :param team_name: string: slug of the team to return
+    :return: obj: github.Team.Team or None
+    """
+    client = find_github_client(org)
+    if client is None:
+        return fetch_team_by_slug(org, team_name)
+    return client.get_team(org, team_name)
+
+
+def get_team_by_id(org, team_id):
     """
-    for team in org.get_teams():
-        if team.slug == team_name:
-            return team
-    return None
+    Team is memoised by client, which fetched organisation.
+    """
+    client = find_github_client(org)
+    if client is None:
+        return org.get_team(team_id)
+    return client.get_team_by_id(org, team_id)
+
+
+def index_team(org, team, team_name=None):
+    """
+    Updates teams memoised by client after team was created or edited.
+    :param team_name: string: name, which team was looked up by
+    """
+    client = find_github_client(org)
+    if client is not None:
+        client.index_team(org, team, team_name)
+
+
+def forget_team(org, team_name):
+    """
+    Drops team memoised by client, so it's fetched again.
+    """
+    client = find_github_client(org)
+    if client is not None:
+        client.forget_team(org, team_name)
 
 
 def get_files(org, repo_name, directory, version):
     """
-    Get a list of the files from given repository
+    Get a list of the files from given repository. In "archive" fetch mode
+    files are extracted from tarball of repository, including files of
+    subdirectories, otherwise only files of directory are requested one by one.
+    If blob cache is enabled, only files missing in it are downloaded. In
+    "mirror" mode files are read from local bare clone of repository, which
+    is fetched incrementally.
     :param org: object: of :class:`github.Organization.Organization`
     :param repo_name: string: of name of the organisational repository where
      files are located
     :param directory: string: of directory in reposo
     :param version: string : branch or tag of repo
-    :return: list :class:`github.ContentFile.ContentFile`
+    :return: list :class:`github.ContentFile.ContentFile` or
+     :class:`common.archive.RepoFile`
     """
-    repo = get_repo(org, repo_name)
-    return repo.get_dir_contents(directory, version)
+    with tracing.span("fetch_files", repo=repo_name):
+        repo = get_repo(org, repo_name)
+        if SETTINGS.GITHUB_FETCH_MODE == "mirror":
+            return _get_mirror(org, repo).read_directory(version, directory)
+        if SETTINGS.GITHUB_FETCH_MODE == "archive":
+            blob_cache = get_blob_cache()
+            if blob_cache:
+                return fetch_directory_cached(
+                    repo, directory, version, blob_cache
+                )
+            return fetch_directory(repo, directory, version)
+        return repo.get_dir_contents(directory, version)
 
 
 def get_hash_of_latest_commit(org, repo_name, branch):
     """
-    Get sha256 hash of latest commit in some branch of the repo.
+    Get sha256 hash of latest commit in some branch of the repo. In "mirror"
+    fetch mode it's resolved by local bare clone of repository.
     :param org: object: of :class:`github.Organization.Organization`
     :param repo_name: string: of name of the organisational repository where
      files are located
     :param branch: string : name of the git branch
     :return: sha256 hash string
     """
-    repo = get_repo(org, repo_name)
-    branch = repo.get_branch(branch)
-    return branch.commit.sha
+    with tracing.span("fetch_commit", repo=repo_name):
+        repo = get_repo(org, repo_name)
+        if SETTINGS.GITHUB_FETCH_MODE == "mirror":
+            return _get_mirror(org, repo).resolve(branch)
+        branch = repo.get_branch(branch)
+        return branch.commit.sha
+
+
+def _get_mirror(org, repo):
+    client = find_github_client(org)
+    return get_mirror(repo.clone_url, client.token if client else None)
 
 
 def valid_project_id_format(project_id):
@@ -0,0 +1,58 @@
+import posixpath
+import tarfile
+from collections import namedtuple
+from contextlib import closing
+
+from settings import SETTINGS
+
+from .cache import git_blob_digest
+from .clients import get_http_session
+
+# file of repository, compatible with :class:`github.ContentFile.ContentFile`
+# attributes used by deployer
+RepoFile = namedtuple("RepoFile", ["name", "path", "decoded_content", "sha"])
+
+
+def fetch_directory(repo, directory, version):
+    """
+    Downloads tarball of repository once, and extracts files of directory
+    while archive is being downloaded, so it's never kept in memory entirely.
+    :param repo: :class:`github.Repository.Repository`
+    :param directory: string: path of directory in repository
+    :param version: string: branch, tag or commit
+    :return: list: of :class:`RepoFile`, including files of subdirectories
+    """
+    url = repo.get_archive_link("tarball", version)
+    response = get_http_session().get(
+        url, stream=True, timeout=SETTINGS.GITHUB_ARCHIVE_TIMEOUT
+    )
+    with closing(response):
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return list(extract_directory(response.raw, directory))
+
+
+def extract_directory(stream, directory):
+    """
+    Reads tarball made by GitHub from stream, and yields files of directory.
+    Paths in GitHub archive start with `<owner>-<repo>-<commit>/`, which is
+    stripped.
+    :param stream: file-like object: with gzipped tar archive
+    :param directory: string: path of directory in repository
+    :return: generator: of :class:`RepoFile`
+    """
+    prefix = directory.strip("/") + "/"
+    with tarfile.open(fileobj=stream, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            _, _, path = member.name.partition("/")
+            if not path.startswith(prefix) or ".." in path.split("/"):
+                continue
+            content = archive.extractfile(member).read()
+            yield RepoFile(
+                posixpath.basename(path),
+                path,
+                content,
+                git_blob_digest(content),
+            )
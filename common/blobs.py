@@ -0,0 +1,96 @@
+import threading
+from base64 import b64decode
+
+from settings import SETTINGS
+
+from .archive import RepoFile, fetch_directory
+from .cache import ContentStore, git_blob_digest
+
+# mode of symbolic links in git trees, their blobs contain target path
+SYMLINK_MODE = "120000"
+
+
+class BlobIntegrityError(Exception):
+    pass
+
+
+def fetch_directory_cached(repo, directory, version, cache):
+    """
+    Fetches files of directory, downloading only blobs, which are missing in
+    cache. Listing of repository tree with blob sha of every file is
+    requested first, then missing blobs are requested one by one, or, if
+    there are more than `GITHUB_BLOB_FETCH_LIMIT` of them, extracted from
+    tarball of repository.
+    :param repo: :class:`github.Repository.Repository`
+    :param directory: string: path of directory in repository
+    :param version: string: branch, tag or commit
+    :param cache: :class:`common.cache.ContentStore`: keyed by git blob sha
+    :return: list: of :class:`common.archive.RepoFile`, including files of
+     subdirectories
+    """
+    prefix = directory.strip("/") + "/"
+    tree = repo.get_git_tree(version, recursive=True)
+    if tree.raw_data.get("truncated"):
+        return _fetch_archive(repo, directory, version, cache)
+
+    entries = [
+        entry
+        for entry in tree.tree
+        if entry.type == "blob"
+        and entry.mode != SYMLINK_MODE
+        and entry.path.startswith(prefix)
+    ]
+    contents = {entry.sha: cache.get(entry.sha) for entry in entries}
+    missing = [sha for sha, content in contents.items() if content is None]
+    if len(missing) > SETTINGS.GITHUB_BLOB_FETCH_LIMIT:
+        return _fetch_archive(repo, directory, version, cache)
+
+    for sha in missing:
+        content = b64decode(repo.get_git_blob(sha).content)
+        if git_blob_digest(content) != sha:
+            raise BlobIntegrityError(f"Content of blob {sha} doesn't match")
+        contents[sha] = content
+        cache.put(content, sha)
+    if missing:
+        cache.evict()
+
+    return [
+        RepoFile(
+            entry.path.rsplit("/", 1)[-1],
+            entry.path,
+            contents[entry.sha],
+            entry.sha,
+        )
+        for entry in entries
+    ]
+
+
+def _fetch_archive(repo, directory, version, cache):
+    files = fetch_directory(repo, directory, version)
+    for file_ in files:
+        cache.put(file_.decoded_content)
+    cache.evict()
+    return files
+
+
+_blob_caches = {}
+_blob_caches_lock = threading.Lock()
+
+
+def get_blob_cache():
+    """
+    Returns blob cache shared by the process, or None if it's disabled in
+    settings.
+    """
+    cache_dir = SETTINGS.get("GITHUB_BLOB_CACHE_DIR")
+    if not cache_dir:
+        return None
+
+    with _blob_caches_lock:
+        if cache_dir not in _blob_caches:
+            _blob_caches[cache_dir] = ContentStore(
+                cache_dir,
+                max_size=SETTINGS.get("GITHUB_BLOB_CACHE_MAX_SIZE"),
+                digest=git_blob_digest,
+            )
+        return _blob_caches[cache_dir]
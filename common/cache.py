@@ -0,0 +1,219 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def sha256_digest(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def git_blob_digest(content):
+    """
+    Calculates the same sha1 digest, that git uses as an id of blob object.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def file_sha256_digest(path, chunk_size=1024 * 1024):
+    """
+    Calculates sha256 digest of file without reading it into memory at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """
+    Content-addressed storage of blobs on local disk. Blobs are written
+    atomically, so storage can be shared between threads and processes.
+    When total size of blobs exceeds `max_size` bytes, least recently used
+    blobs are evicted.
+    """
+
+    def __init__(self, root, max_size=None, digest=sha256_digest):
+        """
+        :param root: path: directory where blobs are stored
+        :param max_size: int: size limit of storage in bytes, unbounded if None
+        :param digest: function: which calculates key of given bytes
+        """
+        self.root = Path(root)
+        self.max_size = max_size
+        self.digest = digest
+        self.hits = 0
+        self.misses = 0
+        self._counters_lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def path(self, key):
+        return self.root / key[:2] / key
+
+    def __contains__(self, key):
+        return self.path(key).exists()
+
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive lock of the storage, that works across threads and processes.
+        """
+        with open(self.root / ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """
+        Returns content of blob, or None if it's missing or corrupted.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        if self.digest(content) != key:
+            self._discard(path)
+            self._count(hit=False)
+            return None
+
+        self._touch(path)
+        self._count(hit=True)
+        return content
+
+    def put(self, content, key=None):
+        """
+        Stores content, if it's not stored yet.
+        :return: string: key of stored blob
+        """
+        key = key or self.digest(content)
+        path = self.path(key)
+        if path.exists():
+            self._touch(path)
+            return key
+
+        with self._temporary_file() as (f, temporary_path):
+            f.write(content)
+        self._replace(temporary_path, path)
+        return key
+
+    def put_file(self, source, key):
+        """
+        Copies file to the storage under given key, if it's not stored yet.
+        """
+        path = self.path(key)
+        if path.exists():
+            self._touch(path)
+            return key
+
+        with self._temporary_file() as (f, temporary_path):
+            with open(source, "rb") as source_file:
+                shutil.copyfileobj(source_file, f)
+        shutil.copymode(source, temporary_path)
+        self._replace(temporary_path, path)
+        return key
+
+    def link(self, key, destination, copy=False):
+        """
+        Materialises blob at destination path, using hard link if possible.
+        :param copy: bool: whether to always copy blob instead of linking it
+        :return: bool: whether blob was found in storage
+        """
+        path = self.path(key)
+        if not path.exists():
+            self._count(hit=False)
+            return False
+
+        os.makedirs(Path(destination).parent, exist_ok=True)
+        try:
+            if copy:
+                raise OSError
+            os.link(path, destination)
+        except OSError:
+            # storage could be on another device, fall back to copying
+            shutil.copy2(path, destination)
+
+        self._touch(path)
+        self._count(hit=True)
+        return True
+
+    def size(self):
+        return sum(path.stat().st_size for path in self._blobs())
+
+    def evict(self):
+        """
+        Removes least recently used blobs until storage fits into `max_size`.
+        """
+        if self.max_size is None:
+            return
+
+        with self.lock():
+            blobs = [(path, path.stat()) for path in self._blobs()]
+            total_size = sum(stat.st_size for _, stat in blobs)
+            blobs.sort(key=lambda blob: blob[1].st_mtime)
+            for path, stat in blobs:
+                if total_size <= self.max_size:
+                    break
+                self._discard(path)
+                total_size -= stat.st_size
+
+    def _blobs(self):
+        for directory in self.root.iterdir():
+            if directory.is_dir():
+                for path in directory.iterdir():
+                    if not path.name.startswith("."):
+                        yield path
+
+    @contextmanager
+    def _temporary_file(self):
+        """
+        Temporary file inside the storage, so it can be atomically renamed
+        to the blob path afterwards.
+        """
+        fd, temporary_path = tempfile.mkstemp(dir=self.root, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f, temporary_path
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def _replace(self, temporary_path, path):
+        os.makedirs(path.parent, exist_ok=True)
+        os.replace(temporary_path, path)
+
+    def _count(self, hit):
+        with self._counters_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
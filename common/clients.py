@@ -0,0 +1,183 @@
+import threading
+
+
+class GithubClient:
+    """
+    GitHub client shared by all users of the same API URL and token.
+    Requests are sent through :class:`common.http_cache.HTTPSConnection`, so
+    keep-alive connections of shared session are reused instead of doing TLS
+    handshake for every new client, and GET responses are revalidated with
+    conditional requests. Organisations, repositories and teams are memoised
+    for the lifetime of the client.
+    """
+
+    def __init__(self, api_url, token):
+        from github import Github
+
+        from .http_cache import install_connection_classes
+
+        install_connection_classes()
+
+        self.api_url = api_url
+        self.token = token
+        self.github = Github(base_url=api_url, login_or_token=token)
+        self._orgs = {}
+        self._repos = {}
+        self._teams = {}
+        self._lock = threading.Lock()
+
+    def get_org(self, name):
+        """
+        :return: :class:`github.Organization.Organization`
+        """
+        return self._memoised(
+            self._orgs, name, lambda: self.github.get_organization(name)
+        )
+
+    def get_repo(self, org, name):
+        """
+        :param org: :class:`github.Organization.Organization`: returned by
+         :meth:`get_org`
+        :return: :class:`github.Repository.Repository`
+        """
+        return self._memoised(
+            self._repos, (org.login, name), lambda: org.get_repo(name)
+        )
+
+    def get_team(self, org, slug):
+        """
+        Team is requested by slug directly, instead of listing teams of
+        organisation, missing teams are memoised too.
+        :return: :class:`github.Team.Team` or None
+        """
+        return self._memoised(
+            self._team_index(org),
+            ("slug", slug),
+            lambda: fetch_team_by_slug(org, slug),
+        )
+
+    def get_team_by_id(self, org, team_id):
+        """
+        :return: :class:`github.Team.Team`
+        """
+        return self._memoised(
+            self._team_index(org),
+            ("id", team_id),
+            lambda: org.get_team(team_id),
+        )
+
+    def index_team(self, org, team, slug=None):
+        """
+        Replaces memoised team after it was created or edited.
+        :param slug: string: slug, which team was looked up by, if it could
+         differ from slug of the team
+        """
+        with self._lock:
+            index = self._teams.setdefault(org.login, {})
+            index.pop(("slug", slug), None)
+            index[("slug", team.slug)] = team
+            index[("id", team.id)] = team
+
+    def forget_team(self, org, slug):
+        """
+        Drops memoised team after it was changed by other means than
+        PyGithub, so it's fetched again.
+        """
+        with self._lock:
+            index = self._teams.setdefault(org.login, {})
+            team = index.pop(("slug", slug), None)
+            if team is not None:
+                index.pop(("id", team.id), None)
+
+    def owns(self, org):
+        with self._lock:
+            return any(cached is org for cached in self._orgs.values())
+
+    def _team_index(self, org):
+        with self._lock:
+            return self._teams.setdefault(org.login, {})
+
+    def _memoised(self, cache, key, fetch):
+        with self._lock:
+            if key in cache:
+                return cache[key]
+        # fetched outside of the lock, so slow requests don't block others,
+        # the first stored object wins
+        value = fetch()
+        with self._lock:
+            return cache.setdefault(key, value)
+
+
+def fetch_team_by_slug(org, slug):
+    """
+    :return: :class:`github.Team.Team` or None, if there is no such team
+    """
+    # github package is PyGithub
+    # noinspection PyPackageRequirements
+    from github import UnknownObjectException
+    from github.Team import Team
+
+    try:
+        if hasattr(org, "get_team_by_slug"):
+            return org.get_team_by_slug(slug)
+        # PyGithub before 1.44 has no method for it
+        headers, data = org._requester.requestJsonAndCheck(
+            "GET", f"{org.url}/teams/{slug}"
+        )
+        return Team(org._requester, headers, data, completed=True)
+    except UnknownObjectException:
+        return None
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_github_client(api_url, token):
+    """
+    Returns client registered for API URL and token, creating it on first
+    request.
+    :return: :class:`GithubClient`
+    """
+    key = (api_url, token)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = GithubClient(api_url, token)
+        return _clients[key]
+
+
+def find_github_client(org):
+    """
+    :return: :class:`GithubClient`, which fetched organisation, or None
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        if client.owns(org):
+            return client
+    return None
+
+
+def clear_github_clients():
+    """
+    Drops registered clients with everything they memoised.
+    """
+    with _clients_lock:
+        _clients.clear()
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    Keep-alive session of `requests`, for API calls PyGithub doesn't support.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+
+            _http_session = requests.Session()
+        return _http_session
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing
+from pathlib import Path
+
+from settings import SETTINGS
+
+from . import rate_limit
+
+# seconds to wait for lock of database held by another process
+LOCK_TIMEOUT = 30
+# number of stored responses, after which old ones are pruned
+PRUNE_INTERVAL = 100
+
+CachedResponse = namedtuple(
+    "CachedResponse", ["etag", "last_modified", "headers", "body"]
+)
+
+
+class ResponseCache:
+    """
+    Persistent cache of GitHub API responses to GET requests, which carry
+    ETag or Last-Modified header. Cached responses are always revalidated by
+    conditional request, GitHub answers with 304 if nothing changed, and
+    such responses are not counted against rate limit.
+    Cache is SQLite database, so it's shared by concurrent workers and
+    processes. Only `max_entries` recently used responses are kept.
+    """
+
+    def __init__(self, path, max_entries):
+        """
+        :param path: path: SQLite database file
+        :param max_entries: int: number of responses kept
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._stored = 0
+        self._counters_lock = threading.Lock()
+
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+            "headers TEXT, body TEXT, used_at REAL)"
+        )
+        # responses could contain content of private repositories
+        os.chmod(path, 0o600)
+
+    @property
+    def stats(self):
+        with self._counters_lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+    @staticmethod
+    def key(url, headers):
+        """
+        Responses differ by credentials and requested media type, token is
+        hashed, so it's never stored.
+        """
+        identity = "\n".join(
+            [url, headers.get("Authorization", ""), headers.get("Accept", "")]
+        )
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def lookup(self, key):
+        """
+        :return: :class:`CachedResponse` or None
+        """
+        rows = self._execute(
+            "SELECT etag, last_modified, headers, body FROM responses "
+            "WHERE key = ?",
+            (key,),
+        )
+        if not rows:
+            return None
+        etag, last_modified, headers, body = rows[0]
+        return CachedResponse(etag, last_modified, json.loads(headers), body)
+
+    def store(self, key, etag, last_modified, headers, body):
+        self._execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                etag,
+                last_modified,
+                json.dumps(dict(headers)),
+                body,
+                time.time(),
+            ),
+        )
+        with self._counters_lock:
+            self._stored += 1
+            prune = self._stored % PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def touch(self, key):
+        self._execute(
+            "UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key)
+        )
+
+    def prune(self):
+        """
+        Removes least recently used responses above `max_entries`.
+        """
+        self._execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY used_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def count(self, hit):
+        with self._counters_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _execute(self, query, parameters=()):
+        # connection per query, so cache could be used from any thread
+        with closing(sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)) as db:
+            with db:
+                return db.execute(query, parameters).fetchall()
+
+
+class _Response:
+    """
+    Mimics httplib response, as PyGithub expects it from connection.
+    """
+
+    def __init__(self, status, headers, body, response=None):
+        self.status = status
+        self.headers = headers
+        self._body = body
+        self._response = response
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self._body or ""
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_content(chunk_size=chunk_size)
+
+    def raise_for_status(self):
+        if self._response is not None:
+            self._response.raise_for_status()
+
+
+class HTTPSConnection:
+    """
+    Mimics httplib connection for PyGithub. PyGithub could hand the same
+    connection to several threads, so request pending until `getresponse` is
+    kept per thread, while keep-alive connections are pooled by the shared
+    `requests` session.
+    Responses to GET requests are revalidated through :class:`ResponseCache`,
+    and requests are paced by :mod:`common.rate_limit`.
+    """
+
+    protocol = "https"
+    default_port = 443
+
+    def __init__(self, host, port=None, timeout=None, **kwargs):
+        self.host = host
+        self.port = port or self.default_port
+        self.timeout = timeout
+        self.verify = kwargs.get("verify", True)
+        self._pending = threading.local()
+
+    def request(self, verb, url, input, headers, stream=False):
+        self._pending.request = (verb, url, input, dict(headers), stream)
+
+    def getresponse(self):
+        verb, url, input, headers, stream = self._pending.request
+        self._pending.request = None
+        url = f"{self.protocol}://{self.host}:{self.port}{url}"
+
+        cache = get_response_cache()
+        key = cached = None
+        if cache and verb == "GET" and not stream:
+            key = cache.key(url, headers)
+            cached = cache.lookup(key)
+        if cached:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        response = rate_limit.request(
+            verb,
+            url,
+            headers=headers,
+            data=input,
+            timeout=self.timeout,
+            verify=self.verify,
+            allow_redirects=False,
+            stream=stream,
+        )
+
+        if cached and response.status_code == 304:
+            cache.count(hit=True)
+            cache.touch(key)
+            # fresh headers carry current rate limit
+            fresh_headers = dict(cached.headers)
+            fresh_headers.update(response.headers)
+            return _Response(200, fresh_headers, cached.body)
+
+        if key:
+            cache.count(hit=False)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response.status_code == 200 and (etag or last_modified):
+                cache.store(
+                    key, etag, last_modified, response.headers, response.text
+                )
+
+        body = None if stream else response.text
+        return _Response(response.status_code, response.headers, body, response)
+
+    def close(self):
+        # connections are pooled by shared session
+        pass
+
+
+class HTTPConnection(HTTPSConnection):
+    protocol = "http"
+    default_port = 80
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install_connection_classes():
+    """
+    Makes PyGithub send requests through :class:`HTTPSConnection`.
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        from github.Requester import Requester
+
+        Requester.injectConnectionClasses(HTTPConnection, HTTPSConnection)
+        _installed = True
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns cache shared by the process, or None if it's disabled in settings.
+    """
+    global _cache
+    path = SETTINGS.get("GITHUB_HTTP_CACHE_FILE")
+    if not path:
+        return None
+
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            _cache = ResponseCache(
+                path, SETTINGS.get("GITHUB_HTTP_CACHE_MAX_ENTRIES")
+            )
+        return _cache
@@ -0,0 +1,200 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from base64 import b64encode
+from contextlib import contextmanager
+from pathlib import Path
+
+from reporter import tracing
+from settings import SETTINGS
+
+from .archive import RepoFile
+
+# mode of symbolic links in git trees, their blobs contain target path
+SYMLINK_MODE = "120000"
+# only branches and tags are mirrored, GitHub also has refs of pull requests
+REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+
+class MirrorError(Exception):
+    pass
+
+
+class RepoMirror:
+    """
+    Bare clone of remote repository. It's fetched once per process, and only
+    objects, which are missing locally, are downloaded, then files and
+    commits are read straight from the object store. Fetches are serialised
+    by file lock, so mirror could be shared by concurrent processes.
+    Requires git 2.9 or newer, which supports `http.extraHeader`.
+    """
+
+    def __init__(self, path, url, token=None):
+        """
+        :param path: path: directory of bare repository
+        :param url: string: of remote repository, `file://` URLs are supported
+        :param token: string: GitHub token, sent in header, so it's never
+         stored in the mirror
+        """
+        self.path = Path(path)
+        self.url = url
+        self.token = token
+        self._fetched = False
+        self._lock = threading.Lock()
+
+    def update(self):
+        """
+        Creates mirror on first use, and fetches new objects of branches and
+        tags, unless it was done already.
+        """
+        with self._lock:
+            if self._fetched:
+                return
+            with tracing.span("fetch_mirror"), self._locked():
+                if not self.path.exists():
+                    self._create()
+                self._git("fetch", "--prune", "--quiet", "origin")
+            self._fetched = True
+
+    def resolve(self, version):
+        """
+        :param version: string: branch, tag or commit
+        :return: string: sha of commit
+        """
+        self.update()
+        commit = self._git(
+            "rev-parse", "--verify", "--quiet", f"{version}^{{commit}}"
+        )
+        return commit.decode().strip()
+
+    def read_directory(self, version, directory):
+        """
+        :param version: string: branch, tag or commit
+        :param directory: string: path of directory in repository
+        :return: list: of :class:`common.archive.RepoFile`, including files of
+         subdirectories
+        """
+        commit = self.resolve(version)
+        prefix = directory.strip("/") + "/"
+        listing = self._git("ls-tree", "-r", "-z", commit, "--", prefix)
+
+        entries = []
+        for line in listing.decode().split("\0"):
+            if not line:
+                continue
+            info, path = line.split("\t", 1)
+            mode, object_type, sha = info.split()
+            if object_type == "blob" and mode != SYMLINK_MODE:
+                entries.append((path, sha))
+
+        contents = self._read_blobs([sha for _, sha in entries])
+        return [
+            RepoFile(path.rsplit("/", 1)[-1], path, contents[sha], sha)
+            for path, sha in entries
+        ]
+
+    def _create(self):
+        # initialised aside, so interrupted creation doesn't leave mirror
+        # without remote
+        os.makedirs(self.path.parent, exist_ok=True)
+        temp_path = tempfile.mkdtemp(dir=self.path.parent)
+        try:
+            self._run(["init", "--bare", "--quiet", temp_path])
+            self._run(["remote", "add", "origin", self.url], temp_path)
+            self._run(
+                ["config", "--unset-all", "remote.origin.fetch"], temp_path
+            )
+            for refspec in REFSPECS:
+                self._run(
+                    ["config", "--add", "remote.origin.fetch", refspec],
+                    temp_path,
+                )
+            os.rename(temp_path, self.path)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+    def _read_blobs(self, shas):
+        if not shas:
+            return {}
+        output = self._git(
+            "cat-file", "--batch", input="\n".join(shas).encode() + b"\n"
+        )
+        contents = {}
+        position = 0
+        for sha in shas:
+            header_end = output.index(b"\n", position)
+            _, _, size = output[position:header_end].split()
+            start = header_end + 1
+            contents[sha] = output[start : start + int(size)]
+            # content is followed by newline
+            position = start + int(size) + 1
+        return contents
+
+    def _git(self, *args, input=None):
+        return self._run(args, self.path, input)
+
+    def _run(self, args, git_dir=None, input=None):
+        env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+        if self.token:
+            # passed like `git -c` does, but token isn't visible in arguments
+            # of process
+            credentials = b64encode(f"x-access-token:{self.token}".encode())
+            header = "Authorization: Basic " + credentials.decode()
+            parameters = f"'http.extraHeader={header}'"
+            if env.get("GIT_CONFIG_PARAMETERS"):
+                parameters = env["GIT_CONFIG_PARAMETERS"] + " " + parameters
+            env["GIT_CONFIG_PARAMETERS"] = parameters
+        git_dir_args = ["--git-dir", str(git_dir)] if git_dir else []
+        result = subprocess.run(
+            ["git", *git_dir_args, *args],
+            env=env,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise MirrorError(
+                f"git {args[0]} failed for {self.url}: "
+                + result.stderr.decode(errors="replace").strip()
+            )
+        return result.stdout
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.path.parent, exist_ok=True)
+        lock_path = self.path.with_name(self.path.name + ".lock")
+        with open(lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(url, token=None):
+    """
+    Returns mirror of repository shared by the process for the same token,
+    directory of mirror is named by hash of URL.
+    :return: :class:`RepoMirror`
+    """
+    key = (url, _digest(token or ""))
+    with _mirrors_lock:
+        if key not in _mirrors:
+            name = _digest(url)[:16] + ".git"
+            _mirrors[key] = RepoMirror(
+                Path(SETTINGS.GITHUB_MIRROR_DIR) / name, url, token
+            )
+        return _mirrors[key]
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode()).hexdigest()
@@ -0,0 +1,259 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from settings import SETTINGS
+
+from .clients import get_http_session
+
+# statuses of responses to requests rejected by primary or secondary limit
+LIMITED_STATUSES = (403, 429)
+
+
+class RateLimiter:
+    """
+    Paces requests to GitHub API, sent with the same token, by token bucket.
+    Rate limit headers of every response are observed: when remaining quota
+    drops below reserve, rest of it is spread evenly until reset, and when
+    it's exhausted, or GitHub asks to retry after some time, all requests are
+    paused. Concurrent projects get fair shares: a free token is granted to
+    the waiting share, which was served least recently.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: float: requests per second
+        :param burst: int: requests sent without waiting after idle period
+        """
+        self.rate = rate
+        self.burst = burst
+        self.requests = 0
+        self.retries = 0
+        self.wait_time = 0.0
+
+        self._current_rate = rate
+        self._tokens = float(burst)
+        self._refilled = self._started = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = []
+        self._served = {}
+        self._grants = 0
+        self._condition = threading.Condition()
+
+    @property
+    def stats(self):
+        with self._condition:
+            elapsed = time.monotonic() - self._started
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "wait_time": self.wait_time,
+                "throughput": self.requests / elapsed if elapsed else 0.0,
+            }
+
+    def acquire(self, share=None):
+        """
+        Blocks until request could be sent.
+        :param share: hashable: requests of the same share are served in
+         turns with other shares, like requests of one project
+        """
+        ticket = (share, object())
+        start = time.monotonic()
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(now)
+                    if delay <= 0 and self._next() is ticket:
+                        break
+                    # woken up earlier, when another request is granted
+                    self._condition.wait(max(delay, 1 / self._current_rate))
+                self._tokens -= 1
+                self._grants += 1
+                self._served[share] = self._grants
+                self.requests += 1
+                self.wait_time += time.monotonic() - start
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+    def observe(self, headers):
+        """
+        Adapts pace to rate limit headers of response.
+        """
+        try:
+            limit = int(headers["X-RateLimit-Limit"])
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+
+        until_reset = max(reset - time.time(), 1.0)
+        with self._condition:
+            if remaining == 0:
+                self._pause(until_reset)
+            elif remaining < limit * SETTINGS.GITHUB_RATE_LIMIT_RESERVE:
+                self._current_rate = min(self.rate, remaining / until_reset)
+            else:
+                self._current_rate = self.rate
+
+    def pause(self, seconds):
+        """
+        Stops all requests for given time, and counts retry.
+        """
+        with self._condition:
+            self.retries += 1
+            self._pause(seconds)
+
+    def _pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._condition.notify_all()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._refilled) * self._current_rate,
+        )
+        self._refilled = now
+
+    def _delay(self, now):
+        refill_delay = (1 - self._tokens) / self._current_rate
+        return max(self._paused_until - now, refill_delay, 0.0)
+
+    def _next(self):
+        # the earliest of waiting requests of the least recently served share
+        return min(
+            enumerate(self._waiting),
+            key=lambda waiting: (
+                self._served.get(waiting[1][0], 0),
+                waiting[0],
+            ),
+        )[1]
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(authorization):
+    """
+    Returns limiter shared by requests with the same credentials, since
+    GitHub limits are counted per user.
+    :param authorization: string: value of Authorization header, or None
+    :return: :class:`RateLimiter`
+    """
+    with _limiters_lock:
+        if authorization not in _limiters:
+            _limiters[authorization] = RateLimiter(
+                SETTINGS.GITHUB_REQUESTS_PER_SECOND,
+                SETTINGS.GITHUB_REQUESTS_BURST,
+            )
+        return _limiters[authorization]
+
+
+def get_stats():
+    """
+    :return: dict: stats of all limiters of the process summed
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    totals = {"requests": 0, "retries": 0, "wait_time": 0.0, "throughput": 0.0}
+    for limiter in limiters:
+        for name, value in limiter.stats.items():
+            totals[name] += value
+    return totals
+
+
+def is_rate_limited(response):
+    if response.status_code not in LIMITED_STATUSES:
+        return False
+    if response.status_code == 429 or "Retry-After" in response.headers:
+        return True
+    return response.headers.get("X-RateLimit-Remaining") == "0"
+
+
+def retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying rejected request: as requested by GitHub,
+    until reset of exhausted limit, or exponential backoff with full jitter,
+    so retries of concurrent requests don't come at once.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    reset = response.headers.get("X-RateLimit-Reset")
+    if response.headers.get("X-RateLimit-Remaining") == "0" and reset:
+        return max(float(reset) - time.time(), 0.0) + 1
+    backoff = min(
+        SETTINGS.GITHUB_RETRY_MAX_BACKOFF,
+        SETTINGS.GITHUB_RETRY_BACKOFF * 2**attempt,
+    )
+    return random.uniform(0, backoff)
+
+
+def request(verb, url, headers=None, **kwargs):
+    """
+    Sends request to GitHub API through shared session, when limiter allows
+    it, and retries it while it's rejected by rate limits.
+    :param kwargs: passed to :meth:`requests.Session.request`
+    :return: :class:`requests.Response`: the last one, if retries ran out
+    """
+    headers = headers or {}
+    limiter = get_rate_limiter(headers.get("Authorization"))
+    attempt = 0
+    while True:
+        limiter.acquire(current_share())
+        response = get_http_session().request(
+            verb, url, headers=headers, **kwargs
+        )
+        limiter.observe(response.headers)
+        if (
+            not is_rate_limited(response)
+            or attempt >= SETTINGS.GITHUB_RATE_LIMIT_RETRIES
+        ):
+            return response
+        limiter.pause(retry_delay(response, attempt))
+        response.close()
+        attempt += 1
+
+
+_context = threading.local()
+
+
+def current_share():
+    return getattr(_context, "share", None)
+
+
+@contextmanager
+def share(name):
+    """
+    Requests sent by the thread inside the block are counted to share of
+    `name`, like project being deployed.
+    """
+    previous = current_share()
+    _context.share = name
+    try:
+        yield
+    finally:
+        _context.share = previous
+
+
+def propagate(function):
+    """
+    Wraps function, so requests sent by it in another thread are counted to
+    the share of the calling thread.
+    """
+    name = current_share()
+    if name is None:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with share(name):
+            return function(*args, **kwargs)
+
+    return wrapper
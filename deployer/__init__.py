@@ -1,13 +1,19 @@
-import os
-import json
-import threading
-from itertools import chain
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_EXCEPTION,
+)
+from threading import Event
 
-from python_terraform import Terraform, TerraformCommandError as TerraformError
+from reporter import tracing
 
-from settings import SETTINGS
+from .ledger import get_validation_ledger
+from .state_diff import diff_states
 
-ERROR_RETURN_CODE = 1
+# outcomes of deploy
+SUCCESS = "success"
+NO_CHANGES = "no_changes"
 
 
 class WrongStateError(Exception):
@@ -16,177 +22,27 @@ class WrongStateError(Exception):
     """
 
 
-class TerraformCommandError(TerraformError):
-    """
-    Redefined existing terraform command error to add content of stdout and stderr.
-    """
-
-    def __str__(self):
-        return f"{super().__str__()}\nSTDOUT:\n{self.out}\nSTDERR:\n{self.err}"
-
-
-class TerraformDeployer(Terraform):
-    def __init__(
-        self, parsed_args, code_files, config_files, testing_ending=None
-    ):
-        self.project_id = (
-            f"testing-{testing_ending}"
-            if testing_ending
-            else parsed_args.project_id
-        )
-
-        self.project_dir = SETTINGS.WORKING_DIR_BASE / self.project_id
-
-        # working directory should be unique for each deployment to prevent
-        # overlapping workspaces
-        self.working_dir = self.project_dir / parsed_args.cloud
-        self.testing_ending = testing_ending
-
-        os.makedirs(self.working_dir, exist_ok=True)
-
-        for file_ in chain(code_files, config_files):
-            with open(self.project_dir / file_.path, "wb") as f:
-                f.write(file_.decoded_content)
-
-        super(TerraformDeployer, self).__init__(working_dir=self.working_dir)
-
-        self.command("get")  # get terraform modules
-        self.init()
-
-        self._create_workspace()
-
-        self.current_state = self.get_state()
-        self.previous_state = None
-
-    def command(self, command, *args, **kwargs):
-        result = self.cmd(command, *args, **kwargs)
-        self._raise_if_bad_return_code(command, *result)
-        return result
-
-    def get_state(self):
-        """
-        Fetches the current state.
-        """
-        result = self.command("state pull")
-        stdout = result[1]
-        return json.loads(stdout) if stdout else {}
-
-    def create_plan(self, destroy=False):
-        plan_file_name = "destroy_plan" if destroy else "plan"
-        plan_path = self.project_dir / plan_file_name
-        skip_delete = "true" if self.testing_ending else "false"
-
-        plan_options = [
-            "-input=false",
-            f"-out={plan_path}",
-            f"-var=project_id={self.project_id}",
-            f"-var=project_name={self.project_id}",
-            f"-var=skip_delete={skip_delete}",
-        ]
-
-        if destroy:
-            plan_options.insert(0, "-destroy")
-
-        arguments = " ".join(plan_options)
-        self.command(f"plan {arguments}")
-
-        return plan_path
-
-    def run(self, plan=False):
-        """
-        Creates plan (or accepts existing) and then runs `terraform apply` command.
-        Not using `Terraform.apply`, because it automatically passes `-var-file` argument,
-        while plan already contain all variables.
-        """
-        state_before_apply = self.get_state()
-
-        plan = self.create_plan() if not plan else plan
-        apply_options = [
-            "-no-color",
-            "-input=false",
-            "-auto-approve=false",
-            str(plan),
-        ]
-        apply_command = f"apply {' '.join(apply_options)}"
-        self.command(apply_command)
-
-        self.previous_state = state_before_apply
-        self.current_state = self.get_state()
-
-    def delete(self):
-        self.run(self.create_plan(destroy=True))
-
-    @staticmethod
-    def _raise_if_bad_return_code(command, return_code, stdout, stderr):
-        if return_code == ERROR_RETURN_CODE:
-            raise TerraformCommandError(return_code, command, stdout, stderr)
-
-    def _create_workspace(self):
-        """
-        Creates workspace if it's not exists and selects it.
-        """
-        workspaces_list = self.command(f"workspace list")[1]
-        if self.project_id not in workspaces_list:
-            self.command(f"workspace new {self.project_id}")
-        self.command(f"workspace select {self.project_id}")
-
-
-def _prepare_state_for_compare(state):
-    """
-    State obtained from `terraform state pull` can contain items
-    that differs from one deployment from another, so we should remove them
-    to compare states.
-    """
-    sanitized_state = state.copy()
-
-    global_keys_to_remove = ["serial", "lineage"]
-
-    for key in global_keys_to_remove:
-        sanitized_state.pop(key, None)
-
-    # delete unique project_id from state
-    outputs = sanitized_state.get("outputs", {})
-    if outputs.get("project_id", {}) is not None:
-        outputs.get("project_id", {}).pop("value", None)
-
-    # delete unique attributes of resources
-    instance_attributes_keys_to_remove = [
-        "id",
-        "name",
-        "number",
-        "project_id",
-        "project",
-        "skip_delete",
-    ]
-    for resource in sanitized_state.get("resources", []):
-        for instance in resource.get("instances", []):
-            attributes = instance.get("attributes") or {}
-            for key in instance_attributes_keys_to_remove:
-                attributes.pop(key, None)
-
-    return sanitized_state
-
-
 def are_states_equal(test_state, real_state):
     """
     Compare state of test deployment against state of real deployment
     """
-    test_state = _prepare_state_for_compare(test_state)
-    real_state = _prepare_state_for_compare(real_state)
-
-    return test_state == real_state
+    return diff_states(test_state, real_state).equal
 
 
 def assert_deployments_equal(test_state, real_state):
-    if not are_states_equal(test_state, real_state):
+    state_diff = diff_states(test_state, real_state)
+    if not state_diff.equal:
         raise WrongStateError(
-            f"\nStates are different.\nCurrent state:\n{test_state}\n\nDeployment state:\n{real_state}"
+            f"\nStates are different, {state_diff.total} changes:\n{state_diff}"
         )
 
 
 def assert_deployments_not_equal(test_state, real_state):
     if are_states_equal(test_state, real_state):
-        raise WrongStateError(f"\nStates are equal:\n{test_state}")
+        resources = len((test_state or {}).get("resources", []))
+        raise WrongStateError(
+            f"\nStates are equal, both contain {resources} resources"
+        )
 
 
 def assert_project_id_did_not_change(project_id, state):
@@ -207,39 +63,228 @@ def assert_deployment_deleted(state):
         WrongStateError(f"\nProject was not deleted, current state:\n{state}")
 
 
-def deploy(parsed_args, code, config, testing_ending=None):
+def _join(*futures, cancellation=None):
+    """
+    Join point of the deploy pipeline: waits until all given futures are
+    done, or until first of them fails. In case of failure, not yet started
+    work is cancelled and the error is re-raised in the calling thread.
+    :param cancellation: :class:`threading.Event`: set in case of failure, to
+     stop terraform commands, which are already running
+    :return: list of futures results, in the same order as futures passed
+    """
+    done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in pending:
+        future.cancel()
+    if pending and cancellation is not None:
+        cancellation.set()
+    for future in done:
+        if future.exception():
+            raise future.exception()
+    return [future.result() for future in futures]
+
+
+def _resolve(value):
+    """
+    Arguments of deploy could be futures of values, which are still being
+    fetched, they are waited for only where they are needed.
+    """
+    return value.result() if isinstance(value, Future) else value
+
+
+def _plan_test_deployment(
+    parsed_args, code, config, testing_ending, code_hash, cancellation=None
+):
+    """
+    Test branch of the pipeline: initialises test deployer and creates its
+    plan.
+    """
+    # python_terraform is imported only, when deployment starts
+    from .terraform import TerraformDeployer
+
+    with tracing.span("plan", deployment="test"):
+        test_deployer = TerraformDeployer(
+            parsed_args,
+            _resolve(code),
+            _resolve(config),
+            _resolve(testing_ending),
+            code_hash=_resolve(code_hash),
+            cancellation=cancellation,
+        )
+        return test_deployer, test_deployer.create_plan()
+
+
+def _plan_real_deployment(
+    parsed_args, code, config, code_hash, cancellation=None
+):
+    """
+    Real branch of the pipeline: initialises real deployer and creates its
+    plan, since neither depends on the test deployment. Deployer is created
+    as soon as files and hash of code commit are fetched.
+    """
+    # python_terraform is imported only, when deployment starts
+    from .terraform import TerraformDeployer
+
+    with tracing.span("plan", deployment="real"):
+        real_deployer = TerraformDeployer(
+            parsed_args,
+            _resolve(code),
+            _resolve(config),
+            code_hash=_resolve(code_hash),
+            cancellation=cancellation,
+        )
+        return real_deployer, real_deployer.create_plan()
+
+
+def _apply_real_deployment(real_deployer, real_plan):
+    with tracing.span("apply", deployment="real"):
+        real_deployer.run(real_plan)
+
+
+def _delete_test_deployment(test_deployer):
+    with tracing.span("delete", deployment="test"):
+        test_deployer.delete()
+
+
+def _deploy_validated(real_deployer, real_plan):
+    """
+    Deploys code and config, which already passed validation, without test
+    deployment.
+    """
+    if not real_deployer.has_changes(real_plan):
+        print("No changes")
+        return NO_CHANGES
+
+    _apply_real_deployment(real_deployer, real_plan)
+    assert_project_id_did_not_change(
+        real_deployer.project_id, real_deployer.current_state
+    )
+
+    print("Success!")
+    return SUCCESS
+
+
+def _is_validated(parsed_args, ledger, code_hash, config_hash):
+    if not ledger:
+        return False
+    if parsed_args.revalidate:
+        ledger.invalidate(code_hash, config_hash, parsed_args.cloud)
+        return False
+    return ledger.is_validated(code_hash, config_hash, parsed_args.cloud)
+
+
+def deploy(
+    parsed_args,
+    code,
+    config,
+    testing_ending=None,
+    code_hash=None,
+    config_hash=None,
+):
     """
-    deploy infrastructure using code and configuration supplied
+    deploy infrastructure using code and configuration supplied.
+    Test and real deployments are initialised and planned concurrently. If
+    plan of real deployment has no changes, nothing is applied. Otherwise
+    real deployment is applied only after test one was verified.
+    Combinations of code and config commits, which passed verification, are
+    recorded in validation ledger, and not tested again.
+    Any argument, except parsed_args, could be a :class:`Future`, so real
+    deployment is initialised, while the rest is still being fetched.
     :param parsed_args: object: which contains arguments required to run code
     :param code: list: of files containing deployment code
     :param config: list: of files containing deployment configuration
     :param testing_ending: string: unique for code and config repos combination of short hashes
+    :param code_hash: string: hash of code repo commit, working directories
+     initialised for it are reused
+    :param config_hash: string: hash of config repo commit
+    :return: string: SUCCESS or NO_CHANGES
     """
-    test_deployer = TerraformDeployer(parsed_args, code, config, testing_ending)
-    real_deployer = TerraformDeployer(parsed_args, code, config)
+    # planning is stopped as soon as one of branches fails, while applies are
+    # never interrupted, so test deployment is not left half-destroyed
+    planning_cancellation = Event()
+    with ThreadPoolExecutor(
+        max_workers=2, thread_name_prefix="deploy"
+    ) as executor:
+        real_deployment_plan = executor.submit(
+            tracing.propagate(_plan_real_deployment),
+            parsed_args,
+            code,
+            config,
+            code_hash,
+            planning_cancellation,
+        )
 
-    test_deployment = threading.Thread(target=test_deployer.run)
-    real_deployment = threading.Thread(target=real_deployer.run)
-    test_deployment_deletion = threading.Thread(target=test_deployer.delete)
+        try:
+            code_hash, config_hash = _resolve(code_hash), _resolve(config_hash)
+            ledger = (
+                get_validation_ledger() if code_hash and config_hash else None
+            )
+            validated = _is_validated(
+                parsed_args, ledger, code_hash, config_hash
+            )
+        except BaseException:
+            planning_cancellation.set()
+            raise
+
+        if validated:
+            ((real_deployer, real_plan),) = _join(real_deployment_plan)
+            real_deployer.cancellation = None
+            return _deploy_validated(real_deployer, real_plan)
+
+        test_deployment_plan = executor.submit(
+            tracing.propagate(_plan_test_deployment),
+            parsed_args,
+            code,
+            config,
+            testing_ending,
+            code_hash,
+            planning_cancellation,
+        )
+        (test_deployer, test_plan), (real_deployer, real_plan) = _join(
+            test_deployment_plan,
+            real_deployment_plan,
+            cancellation=planning_cancellation,
+        )
+        test_deployer.cancellation = real_deployer.cancellation = None
 
-    test_deployment.run()
-    assert_project_id_did_not_change(
-        test_deployer.project_id, test_deployer.current_state
-    )
-    assert_deployments_not_equal(
-        test_deployer.current_state, real_deployer.current_state
-    )
+        if not real_deployer.has_changes(real_plan):
+            print("No changes")
+            return NO_CHANGES
+
+        with tracing.span("apply", deployment="test"):
+            test_deployer.run(test_plan)
+
+        assert_project_id_did_not_change(
+            test_deployer.project_id, test_deployer.current_state
+        )
+        with tracing.span("compare_states"):
+            assert_deployments_not_equal(
+                test_deployer.current_state, real_deployer.current_state
+            )
+
+        # test deployment is verified, so it can be destroyed while real one
+        # is being applied, we compare against the state captured before
+        test_state = test_deployer.current_state
+
+        _join(
+            executor.submit(
+                tracing.propagate(_apply_real_deployment),
+                real_deployer,
+                real_plan,
+            ),
+            executor.submit(
+                tracing.propagate(_delete_test_deployment), test_deployer
+            ),
+        )
 
-    real_deployment.run()
     assert_project_id_did_not_change(
         real_deployer.project_id, real_deployer.current_state
     )
-    assert_deployments_equal(
-        test_deployer.current_state, real_deployer.current_state
-    )
-
-    test_deployment_deletion.run()
+    with tracing.span("compare_states"):
+        assert_deployments_equal(test_state, real_deployer.current_state)
     assert_deployment_deleted(test_deployer.current_state)
 
+    if ledger:
+        ledger.record(code_hash, config_hash, parsed_args.cloud)
+
     print("Success!")
-    return True
+    return SUCCESS
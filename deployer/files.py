@@ -0,0 +1,95 @@
+import fcntl
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from common.cache import git_blob_digest
+
+MANIFEST_FILE = ".manifest.json"
+LOCK_FILE = ".lock"
+
+
+def file_sha(file_):
+    """
+    Git blob sha of repository file. GitHub content objects already carry it,
+    for other files it's calculated from content.
+    """
+    return getattr(file_, "sha", None) or git_blob_digest(file_.decoded_content)
+
+
+def materialise(project_dir, files, scope):
+    """
+    Writes repository files into project directory. Manifest in project
+    directory keeps git blob sha of every written file, so files with
+    unchanged content are not rewritten, and files written previously in the
+    same scope, but missing now, are removed.
+    Files are replaced atomically under the lock of project directory, so
+    concurrent deployer never sees half-written file tree.
+    :param project_dir: path: directory, file paths are relative to
+    :param files: iterable: of :class:`github.ContentFile.ContentFile`
+    :param scope: string: part of manifest, files belong to, like cloud name
+    :return: list: of paths of changed files
+    """
+    project_dir = Path(project_dir)
+    changed = []
+
+    with _locked(project_dir):
+        manifest = _read_manifest(project_dir)
+        written = manifest.get(scope, {})
+        materialised = {}
+
+        for file_ in files:
+            sha = file_sha(file_)
+            materialised[file_.path] = sha
+            path = project_dir / file_.path
+            if written.get(file_.path) == sha and path.exists():
+                continue
+            _write_atomically(path, file_.decoded_content)
+            changed.append(file_.path)
+
+        for removed_path in sorted(set(written) - set(materialised)):
+            try:
+                os.remove(project_dir / removed_path)
+            except FileNotFoundError:
+                pass
+            changed.append(removed_path)
+
+        manifest[scope] = materialised
+        _write_atomically(
+            project_dir / MANIFEST_FILE, json.dumps(manifest).encode()
+        )
+
+    return changed
+
+
+@contextmanager
+def _locked(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(directory / LOCK_FILE, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_manifest(directory):
+    try:
+        with open(directory / MANIFEST_FILE) as manifest_file:
+            return json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_atomically(path, content):
+    os.makedirs(path.parent, exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=path.parent, prefix=".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
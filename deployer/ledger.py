@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+from settings import SETTINGS
+
+# seconds to wait for lock of database held by another process
+LOCK_TIMEOUT = 30
+
+
+class ValidationLedger:
+    """
+    Persistent record of code and config commits combinations, which passed
+    validation through test deployment to some cloud. Records expire after
+    `ttl` seconds, and could be invalidated manually.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        :param path: path: SQLite database file
+        :param ttl: int: seconds, validation is trusted for
+        """
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS validations ("
+            "code_hash TEXT, config_hash TEXT, cloud TEXT, validated_at REAL, "
+            "PRIMARY KEY (code_hash, config_hash, cloud))"
+        )
+
+    def is_validated(self, code_hash, config_hash, cloud):
+        rows = self._execute(
+            "SELECT validated_at FROM validations "
+            "WHERE code_hash = ? AND config_hash = ? AND cloud = ?",
+            (code_hash, config_hash, cloud),
+        )
+        return bool(rows) and rows[0][0] > time.time() - self.ttl
+
+    def record(self, code_hash, config_hash, cloud):
+        self._execute(
+            "INSERT OR REPLACE INTO validations VALUES (?, ?, ?, ?)",
+            (code_hash, config_hash, cloud, time.time()),
+        )
+
+    def invalidate(self, code_hash=None, config_hash=None, cloud=None):
+        """
+        Removes records matching all given values, or all records if nothing
+        is given.
+        """
+        conditions = {
+            "code_hash": code_hash,
+            "config_hash": config_hash,
+            "cloud": cloud,
+        }
+        conditions = {
+            column: value
+            for column, value in conditions.items()
+            if value is not None
+        }
+        where = " AND ".join(f"{column} = ?" for column in conditions)
+        self._execute(
+            "DELETE FROM validations" + (f" WHERE {where}" if where else ""),
+            tuple(conditions.values()),
+        )
+
+    def _execute(self, query, parameters=()):
+        # connection per query, so ledger could be used from any thread
+        with closing(sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)) as db:
+            with db:
+                return db.execute(query, parameters).fetchall()
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_validation_ledger():
+    """
+    Returns ledger shared by the process, or None if it's disabled in settings.
+    """
+    global _ledger
+    path = SETTINGS.get("VALIDATION_LEDGER_FILE")
+    if not path:
+        return None
+
+    with _ledger_lock:
+        if _ledger is None or _ledger.path != path:
+            _ledger = ValidationLedger(
+                path, SETTINGS.get("VALIDATION_LEDGER_TTL")
+            )
+        return _ledger
@@ -0,0 +1,172 @@
+import json
+import os
+import tempfile
+import threading
+from itertools import chain
+from pathlib import Path
+
+from common.cache import ContentStore, file_sha256_digest
+from settings import SETTINGS
+
+TERRAFORM_DIR = Path(".terraform")
+PLUGINS_DIR = TERRAFORM_DIR / "plugins"
+MODULES_DIR = TERRAFORM_DIR / "modules"
+
+# files, which terraform rewrites during each init
+NOT_CACHED_FILES = ("lock.json",)
+
+
+class PluginCache:
+    """
+    Cache of terraform providers and modules, shared between all working
+    directories. Files are kept in :class:`common.cache.ContentStore`, while
+    index maps their path inside working directory to keys of stored blobs.
+    Providers and modules are indexed by digest of code, they were installed
+    for, so working directory gets only providers its code requires. Blobs of
+    the same provider are shared by all code versions.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = Path(cache_dir)
+        self.store = ContentStore(self.cache_dir / "objects", max_size)
+        self.hits = 0
+        self.misses = 0
+        self._index_path = self.cache_dir / "index.json"
+        self._counters_lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def restore(self, working_dir, code_key):
+        """
+        Links cached providers and modules into working directory, so
+        `terraform init` doesn't need to download them.
+        :param working_dir: path: terraform working directory
+        :param code_key: string: digest of code, which requires providers and
+         modules
+        """
+        index = self._read_index()
+        entries = dict(index["plugins"].get(code_key, {}))
+        modules = index["modules"].get(code_key, {})
+        # partially restored modules would be considered as installed by
+        # terraform, so they are restored only when all of them are cached
+        if all(key in self.store for key in modules.values()):
+            entries.update(modules)
+
+        restored = 0
+        for relative_path, key in entries.items():
+            destination = Path(working_dir) / relative_path
+            if destination.exists():
+                continue
+            # modules could be rewritten by terraform, so they are copied
+            copy = not relative_path.startswith(str(PLUGINS_DIR))
+            if self.store.link(key, destination, copy=copy):
+                restored += 1
+        self._count(hits=restored)
+
+    def save(self, working_dir, code_key):
+        """
+        Stores providers and modules installed by `terraform init` that are
+        not cached yet.
+        """
+        with self.store.lock():
+            index = self._read_index()
+            cached_plugins = index["plugins"].get(code_key, {})
+            cached_modules = index["modules"].get(code_key, {})
+            # providers of other code could be linked, when the same version
+            # is required
+            linked_plugins = {}
+            for entries in index["plugins"].values():
+                linked_plugins.update(entries)
+            plugins = self._collect(working_dir, PLUGINS_DIR, linked_plugins)
+            modules = self._collect(working_dir, MODULES_DIR, cached_modules)
+
+            known = set(cached_plugins.items())
+            known.update(cached_modules.items())
+            installed = set(plugins.items()) | set(modules.items())
+            self._count(misses=len(installed - known))
+
+            for relative_path, key in chain(plugins.items(), modules.items()):
+                self.store.put_file(Path(working_dir) / relative_path, key)
+
+            if plugins:
+                index["plugins"][code_key] = plugins
+            if modules:
+                index["modules"][code_key] = modules
+            self._write_index(index)
+
+        self.store.evict()
+
+    def _collect(self, working_dir, directory, cached):
+        """
+        Files linked from the storage are not hashed again, since providers
+        could weigh hundreds of megabytes.
+        :param cached: dict: index entries of files restored from the cache
+        :return: dict: paths of files under directory mapped to their digests
+        """
+        files = {}
+        for root, _, file_names in os.walk(Path(working_dir) / directory):
+            for file_name in file_names:
+                if file_name in NOT_CACHED_FILES:
+                    continue
+                path = Path(root) / file_name
+                relative_path = str(path.relative_to(working_dir))
+                key = cached.get(relative_path)
+                if not (key and self._is_linked(path, key)):
+                    key = file_sha256_digest(path)
+                files[relative_path] = key
+        return files
+
+    def _is_linked(self, path, key):
+        try:
+            return os.path.samefile(path, self.store.path(key))
+        except FileNotFoundError:
+            return False
+
+    def _read_index(self):
+        try:
+            with open(self._index_path) as index_file:
+                index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        for section in ("plugins", "modules"):
+            # providers were indexed by path only in older indexes
+            index[section] = {
+                code_key: entries
+                for code_key, entries in index.get(section, {}).items()
+                if isinstance(entries, dict)
+            }
+        return index
+
+    def _write_index(self, index):
+        fd, temporary_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".")
+        with os.fdopen(fd, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temporary_path, self._index_path)
+
+    def _count(self, hits=0, misses=0):
+        with self._counters_lock:
+            self.hits += hits
+            self.misses += misses
+
+
+_plugin_caches = {}
+_plugin_caches_lock = threading.Lock()
+
+
+def get_plugin_cache():
+    """
+    Returns plugin cache shared by all deployers of the process, or None if
+    cache is disabled in settings.
+    """
+    cache_dir = SETTINGS.get("TERRAFORM_PLUGIN_CACHE_DIR")
+    if not cache_dir:
+        return None
+
+    with _plugin_caches_lock:
+        if cache_dir not in _plugin_caches:
+            _plugin_caches[cache_dir] = PluginCache(
+                cache_dir, SETTINGS.get("TERRAFORM_PLUGIN_CACHE_MAX_SIZE")
+            )
+        return _plugin_caches[cache_dir]
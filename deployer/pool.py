@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from uuid import uuid4
+
+from settings import SETTINGS
+
+from .plugin_cache import TERRAFORM_DIR, PLUGINS_DIR
+
+# file with selected workspace, which belongs to some deployment
+WORKSPACE_FILE = "environment"
+# file with hash of code commit, terraform directory was initialised for
+CODE_HASH_FILE = ".code_hash"
+
+
+class WorkingDirPool:
+    """
+    Pool of terraform directories (`.terraform`), initialised by
+    `terraform init` for some commit of code repository. Deployers claim them
+    instead of running init: pooled directory is cloned into deployer's
+    working directory, providers are hard linked, and other files are copied.
+    Code and config files are not pooled, since they are materialised by
+    :func:`deployer.files.materialise`.
+    Pool keeps `size` least recently claimed directories, stored as
+    `<pool_dir>/<cloud>/<code_hash>`.
+    """
+
+    def __init__(self, pool_dir, size):
+        self.pool_dir = Path(pool_dir)
+        self.size = size
+
+    def path(self, code_hash, cloud):
+        return self.pool_dir / cloud / code_hash
+
+    def claim(self, code_hash, cloud, working_dir):
+        """
+        Clones pooled directory into working directory.
+        :param code_hash: string: hash of code repository commit
+        :param cloud: string: name of cloud, code is deployed to
+        :param working_dir: path: working directory of deployer
+        :return: bool: whether directory was found in pool
+        """
+        terraform_dir = Path(working_dir) / TERRAFORM_DIR
+        if _read_code_hash(terraform_dir) == code_hash:
+            # working directory is already initialised for the same code
+            return True
+
+        pooled_dir = self.path(code_hash, cloud)
+        if not pooled_dir.is_dir():
+            return False
+
+        # providers and modules of previous code should not be left
+        shutil.rmtree(terraform_dir, ignore_errors=True)
+        try:
+            _clone_tree(pooled_dir, terraform_dir)
+        except FileNotFoundError:
+            # directory was evicted while being cloned
+            return False
+
+        os.utime(pooled_dir)
+        return True
+
+    def add(self, code_hash, cloud, working_dir):
+        """
+        Puts terraform directory of initialised working directory to the pool.
+        """
+        terraform_dir = Path(working_dir) / TERRAFORM_DIR
+        _write_code_hash(terraform_dir, code_hash)
+
+        pooled_dir = self.path(code_hash, cloud)
+        if pooled_dir.is_dir():
+            return
+
+        os.makedirs(pooled_dir.parent, exist_ok=True)
+        temporary_dir = Path(
+            tempfile.mkdtemp(dir=pooled_dir.parent, prefix=".")
+        )
+        try:
+            _clone_tree(
+                terraform_dir, temporary_dir, skip={Path(WORKSPACE_FILE)}
+            )
+            os.rename(temporary_dir, pooled_dir)
+        except OSError:
+            # same directory was pooled concurrently
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            return
+
+        self._evict(cloud)
+
+    def invalidate(self, code_hash, cloud, working_dir=None):
+        """
+        Removes directory initialised for given commit from the pool.
+        :param working_dir: path: working directory, which was cloned from
+         the pooled one, it's not considered as initialised anymore
+        """
+        self._remove(self.path(code_hash, cloud))
+        if working_dir:
+            try:
+                os.remove(Path(working_dir) / TERRAFORM_DIR / CODE_HASH_FILE)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self, cloud):
+        pooled_dirs = [
+            path
+            for path in (self.pool_dir / cloud).iterdir()
+            if not path.name.startswith(".")
+        ]
+        pooled_dirs.sort(key=lambda path: path.stat().st_mtime, reverse=True)
+        for path in pooled_dirs[self.size :]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(pooled_dir):
+        """
+        Renames directory before removal, so it's never claimed half-removed.
+        """
+        removed_dir = pooled_dir.parent / f".removed-{uuid4().hex}"
+        try:
+            os.rename(pooled_dir, removed_dir)
+        except OSError:
+            return
+        shutil.rmtree(removed_dir, ignore_errors=True)
+
+
+def _clone_tree(source, destination, skip=()):
+    """
+    Clones terraform directory tree, hard linking providers, which are
+    immutable and could be large, and copying other files.
+    :param skip: set: of paths relative to source, which are not cloned
+    """
+    source = Path(source)
+    destination = Path(destination)
+    for root, _, file_names in os.walk(source):
+        relative_root = Path(root).relative_to(source)
+        os.makedirs(destination / relative_root, exist_ok=True)
+        for file_name in file_names:
+            relative_path = relative_root / file_name
+            if relative_path in skip:
+                continue
+            target = destination / relative_path
+            if target.exists():
+                os.remove(target)
+            if _is_provider(relative_path):
+                try:
+                    os.link(source / relative_path, target)
+                    continue
+                except OSError:
+                    # pool could be on another device
+                    pass
+            shutil.copy2(source / relative_path, target)
+
+
+def _read_code_hash(terraform_dir):
+    try:
+        return (terraform_dir / CODE_HASH_FILE).read_text()
+    except FileNotFoundError:
+        return None
+
+
+def _write_code_hash(terraform_dir, code_hash):
+    (terraform_dir / CODE_HASH_FILE).write_text(code_hash)
+
+
+def _is_provider(relative_path):
+    return relative_path.parts[:1] == (PLUGINS_DIR.name,)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_working_dir_pool():
+    """
+    Returns pool shared by all deployers of the process, or None if pool is
+    disabled in settings.
+    """
+    pool_dir = SETTINGS.get("WORKING_DIR_POOL_DIR")
+    size = SETTINGS.get("WORKING_DIR_POOL_SIZE")
+    if not pool_dir or not size:
+        return None
+
+    with _pools_lock:
+        if pool_dir not in _pools:
+            _pools[pool_dir] = WorkingDirPool(pool_dir, size)
+        return _pools[pool_dir]
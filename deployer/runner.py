@@ -0,0 +1,156 @@
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+# seconds between checks of timeout and cancellation of running command
+POLL_INTERVAL = 0.1
+# seconds given to interrupted command to stop gracefully, before it's killed
+STOP_GRACE_PERIOD = 30
+
+
+class CommandInterruptedError(Exception):
+    """
+    Command was stopped before it finished.
+    """
+
+    reason = "interrupted"
+
+    def __init__(self, command, out, err):
+        super().__init__(command, out, err)
+        self.command = command
+        self.out = out
+        self.err = err
+
+    def __str__(self):
+        return (
+            f"Command '{self.command}' was {self.reason}"
+            f"\nSTDOUT (tail):\n{self.out}\nSTDERR (tail):\n{self.err}"
+        )
+
+
+class CommandTimeoutError(CommandInterruptedError):
+    reason = "timed out"
+
+
+class CommandCancelledError(CommandInterruptedError):
+    reason = "cancelled"
+
+
+def run_command(
+    cmds,
+    logger,
+    cwd=None,
+    env=None,
+    timeout=None,
+    cancellation=None,
+    capture_stdout=False,
+    tail_lines=200,
+):
+    """
+    Runs command, forwarding lines of its output to logger as they arrive.
+    Only last `tail_lines` lines of output are kept for error reports, unless
+    stdout is captured completely, like state printed by `terraform state
+    pull`. Captured stdout could contain secrets, so it's never logged.
+    :param cmds: list: command and its arguments
+    :param logger: :class:`logging.Logger`: which receives output lines
+    :param timeout: float: seconds, after which command is stopped
+    :param cancellation: :class:`threading.Event`: command is stopped, once
+     it's set
+    :param capture_stdout: bool: whether complete stdout is returned
+    :param tail_lines: int: number of last lines of output kept
+    :return: tuple: return code, stdout and tail of stderr
+    :raises CommandTimeoutError: if command didn't finish in time
+    :raises CommandCancelledError: if command was cancelled
+    """
+    command = " ".join(str(part) for part in cmds)
+    logger.debug(f"running {command}")
+
+    process = subprocess.Popen(
+        cmds,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        env=env,
+        encoding="utf-8",
+        errors="replace",
+    )
+
+    stdout = [] if capture_stdout else deque(maxlen=tail_lines)
+    stderr = deque(maxlen=tail_lines)
+    readers = [
+        threading.Thread(
+            target=_forward,
+            args=(
+                process.stdout,
+                stdout,
+                None if capture_stdout else logger.info,
+                command,
+            ),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=_forward,
+            args=(process.stderr, stderr, logger.warning, command),
+            daemon=True,
+        ),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        interruption = _wait(process, timeout, cancellation)
+    finally:
+        for reader in readers:
+            reader.join()
+
+    out, err = "".join(stdout), "".join(stderr)
+    if capture_stdout:
+        logger.debug(f"{command}: captured {len(stdout)} lines of output")
+    if interruption:
+        raise interruption(command, out, err)
+    return process.returncode, out, err
+
+
+def _forward(stream, buffer, log, command):
+    with stream:
+        for line in stream:
+            buffer.append(line)
+            if log:
+                log(f"{command}: {line.rstrip()}")
+
+
+def _wait(process, timeout, cancellation):
+    """
+    Waits until process finishes, or stops it, if it timed out or was
+    cancelled.
+    :return: class of interruption error, or None if process finished
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            process.wait(POLL_INTERVAL)
+            return None
+        except subprocess.TimeoutExpired:
+            pass
+
+        if cancellation is not None and cancellation.is_set():
+            _stop(process)
+            return CommandCancelledError
+        if deadline is not None and time.monotonic() > deadline:
+            _stop(process)
+            return CommandTimeoutError
+
+
+def _stop(process):
+    """
+    Interrupts process, so terraform could release state lock, and kills it,
+    if it doesn't stop in time.
+    """
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(STOP_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
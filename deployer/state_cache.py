@@ -0,0 +1,99 @@
+import json
+import re
+import threading
+
+# state header is printed before resources, so it's enough to look at the
+# beginning of pulled state to find out, whether it's changed
+HEADER_SIZE = 512
+SERIAL_PATTERN = re.compile(r'"serial":\s*(\d+)')
+LINEAGE_PATTERN = re.compile(r'"lineage":\s*"([^"]*)"')
+
+# commands, which could change state or select another one
+MUTATING_COMMANDS = (
+    "apply",
+    "destroy",
+    "import",
+    "refresh",
+    "taint",
+    "untaint",
+    "workspace",
+    "state push",
+    "state rm",
+    "state mv",
+    "state replace-provider",
+)
+
+
+class StateCache:
+    """
+    Keeps last pulled state of deployment with its serial and lineage.
+    Cached state is valid until some mutating command runs, or until
+    fingerprint of local state file changes, so `terraform state pull`
+    could be skipped. Remote backends have no local state file, so their
+    state has no fingerprint, and it's pulled every time. Pulled state with
+    the same serial and lineage is not parsed again, and the same object is
+    returned, so `previous_state` and `current_state` of deployer share it
+    without copying.
+    """
+
+    def __init__(self):
+        self.state = None
+        self.serial = None
+        self.lineage = None
+        self._fingerprint = None
+        self._valid = False
+        self._lock = threading.Lock()
+
+    def get(self, fingerprint):
+        """
+        :param fingerprint: hashable: cheap identity of state storage, like
+         modification time and size of local state file, None if unknown
+        :return: cached state, or None if state should be pulled
+        """
+        # state of remote backend could be changed by anyone, so it's always
+        # pulled, though it's not parsed again, if its serial is the same
+        if fingerprint is None:
+            return None
+        with self._lock:
+            if self._valid and fingerprint == self._fingerprint:
+                return self.state
+        return None
+
+    def update(self, pulled_state, fingerprint):
+        """
+        Updates cache with output of `terraform state pull`.
+        :return: dict: parsed state
+        """
+        serial, lineage = _parse_header(pulled_state)
+        with self._lock:
+            same_state = (
+                self.state is not None
+                and serial is not None
+                and (serial, lineage) == (self.serial, self.lineage)
+            )
+            if not same_state:
+                self.state = json.loads(pulled_state) if pulled_state else {}
+                self.serial, self.lineage = serial, lineage
+            self._fingerprint = fingerprint
+            self._valid = True
+            return self.state
+
+    def invalidate(self):
+        with self._lock:
+            self._valid = False
+
+    def invalidate_after(self, command):
+        """
+        Invalidates cache, if command could change state.
+        """
+        if command.startswith(MUTATING_COMMANDS):
+            self.invalidate()
+
+
+def _parse_header(pulled_state):
+    header = (pulled_state or "")[:HEADER_SIZE]
+    serial = SERIAL_PATTERN.search(header)
+    lineage = LINEAGE_PATTERN.search(header)
+    if not (serial and lineage):
+        return None, None
+    return int(serial.group(1)), lineage.group(1)
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+
+# top level keys of state, which differ from one deployment to another
+GLOBAL_KEYS_TO_IGNORE = ("serial", "lineage")
+
+# unique attributes of resources
+INSTANCE_ATTRIBUTES_TO_IGNORE = (
+    "id",
+    "name",
+    "number",
+    "project_id",
+    "project",
+    "skip_delete",
+)
+
+# unique outputs, only their values are ignored
+OUTPUTS_VALUES_TO_IGNORE = ("project_id",)
+
+MAX_REPORTED_CHANGES = 20
+MAX_REPORTED_ATTRIBUTES = 10
+
+# number of indexed states kept in memory
+INDEX_CACHE_SIZE = 16
+
+Change = namedtuple("Change", ["address", "kind", "attributes"])
+
+IndexedInstance = namedtuple(
+    "IndexedInstance", ["digest", "resource", "instance"]
+)
+
+
+class StateDiff:
+    """
+    Compact report of differences between two states, bounded in size.
+    """
+
+    def __init__(self, changes, total):
+        """
+        :param changes: list: of first :class:`Change` found
+        :param total: int: number of all found changes
+        """
+        self.changes = changes
+        self.total = total
+
+    @property
+    def equal(self):
+        return self.total == 0
+
+    def __str__(self):
+        lines = []
+        for change in self.changes:
+            line = f"{change.kind}: {change.address}"
+            if change.attributes:
+                line += f" ({', '.join(change.attributes)})"
+            lines.append(line)
+        if self.total > len(self.changes):
+            lines.append(f"... and {self.total - len(self.changes)} more")
+        return "\n".join(lines)
+
+
+def diff_states(test_state, real_state, max_changes=MAX_REPORTED_CHANGES):
+    """
+    Compares states of two deployments. Resource instances are indexed by
+    their address, and compared by digests of their sanitised content, so
+    only changed instances are inspected in details.
+    :return: :class:`StateDiff`
+    """
+    changes = []
+    total = 0
+
+    def report(address, kind, attributes=()):
+        nonlocal total
+        total += 1
+        if len(changes) < max_changes:
+            changes.append(Change(address, kind, attributes))
+
+    test_index = index_state(test_state)
+    real_index = index_state(real_state)
+
+    if test_index["globals"] != real_index["globals"]:
+        report("state", "changed")
+
+    for address in sorted(set(test_index) | set(real_index), key=str):
+        if address == "globals":
+            continue
+        test_instance = test_index.get(address)
+        real_instance = real_index.get(address)
+        if real_instance is None:
+            report(_format_address(address), "removed")
+        elif test_instance is None:
+            report(_format_address(address), "added")
+        elif test_instance.digest != real_instance.digest:
+            report(
+                _format_address(address),
+                "changed",
+                _changed_attributes(test_instance, real_instance),
+            )
+
+    return StateDiff(changes, total)
+
+
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def index_state(state):
+    """
+    Indexes sanitised state. Since lineage and serial identify the content of
+    state, index is reused for the same state, so it's read-only.
+    :return: :class:`types.MappingProxyType`: with :class:`IndexedInstance`
+     by address of every resource instance, and digest of the rest of state
+     by "globals" key
+    """
+    state = state or {}
+    cache_key = (state.get("lineage"), state.get("serial"))
+    cacheable = None not in cache_key
+    if cacheable:
+        with _index_cache_lock:
+            if cache_key in _index_cache:
+                _index_cache.move_to_end(cache_key)
+                return _index_cache[cache_key]
+
+    index = {"globals": _digest(_sanitize_globals(state))}
+    for resource in state.get("resources", []):
+        resource_meta = {
+            key: value for key, value in resource.items() if key != "instances"
+        }
+        for instance in resource.get("instances", []):
+            address = (
+                resource.get("module"),
+                resource.get("mode"),
+                resource.get("type"),
+                resource.get("name"),
+                instance.get("index_key"),
+            )
+            index[address] = IndexedInstance(
+                _digest([resource_meta, _sanitize_instance(instance)]),
+                resource,
+                instance,
+            )
+
+    index = MappingProxyType(index)
+    if cacheable:
+        with _index_cache_lock:
+            _index_cache[cache_key] = index
+            while len(_index_cache) > INDEX_CACHE_SIZE:
+                _index_cache.popitem(last=False)
+    return index
+
+
+def _sanitize_globals(state):
+    """
+    Sanitises everything except resources, which are indexed separately.
+    """
+    sanitized = {
+        key: value
+        for key, value in state.items()
+        if key not in GLOBAL_KEYS_TO_IGNORE + ("resources", "outputs")
+    }
+    outputs = {}
+    for name, output in (state.get("outputs") or {}).items():
+        if name in OUTPUTS_VALUES_TO_IGNORE and output is not None:
+            output = {
+                key: value for key, value in output.items() if key != "value"
+            }
+        outputs[name] = output
+    sanitized["outputs"] = outputs
+    return sanitized
+
+
+def _sanitize_instance(instance):
+    sanitized = dict(instance)
+    sanitized["attributes"] = _sanitize_attributes(instance)
+    return sanitized
+
+
+def _sanitize_attributes(instance):
+    return {
+        key: value
+        for key, value in (instance.get("attributes") or {}).items()
+        if key not in INSTANCE_ATTRIBUTES_TO_IGNORE
+    }
+
+
+def _changed_attributes(test_instance, real_instance):
+    """
+    :return: tuple: names of attributes, which differ in instances, and other
+     keys of instances, if attributes are the same
+    """
+    test_attributes = _sanitize_attributes(test_instance.instance)
+    real_attributes = _sanitize_attributes(real_instance.instance)
+    changed = sorted(
+        key
+        for key in set(test_attributes) | set(real_attributes)
+        if test_attributes.get(key, KeyError)
+        != real_attributes.get(key, KeyError)
+    )
+    if not changed:
+        # only metadata of resource or instance differs
+        test_meta = dict(test_instance.resource, **test_instance.instance)
+        real_meta = dict(real_instance.resource, **real_instance.instance)
+        changed = sorted(
+            key
+            for key in set(test_meta) | set(real_meta)
+            if key not in ("attributes", "instances")
+            and test_meta.get(key, KeyError) != real_meta.get(key, KeyError)
+        )
+    if len(changed) > MAX_REPORTED_ATTRIBUTES:
+        changed = changed[:MAX_REPORTED_ATTRIBUTES] + ["..."]
+    return tuple(changed)
+
+
+def _format_address(address):
+    module, mode, type_, name, index_key = address
+    parts = [module] if module else []
+    parts.append(f"{'data.' if mode == 'data' else ''}{type_}.{name}")
+    address = ".".join(parts)
+    if index_key is not None:
+        address += f"[{json.dumps(index_key)}]"
+    return address
+
+
+def _digest(value):
+    serialized = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode()).hexdigest()
@@ -0,0 +1,312 @@
+import os
+import hashlib
+from itertools import chain
+
+from python_terraform import Terraform, TerraformCommandError as TerraformError
+
+import reporter.local
+from reporter import tracing
+from settings import SETTINGS
+
+from .files import materialise, file_sha
+from .plugin_cache import get_plugin_cache
+from .pool import get_working_dir_pool
+from .runner import run_command
+from .state_cache import StateCache
+
+ERROR_RETURN_CODE = 1
+# `terraform plan -detailed-exitcode` returns it, when plan contains changes
+PLAN_HAS_CHANGES_RETURN_CODE = 2
+# terraform prints it, when providers or modules of directory are missing
+INIT_REQUIRED_MESSAGE = "terraform init"
+
+
+class TerraformCommandError(TerraformError):
+    """
+    Redefined existing terraform command error to add content of stdout and stderr.
+    Unless output was captured completely, only its tail is kept.
+    """
+
+    def __str__(self):
+        return f"{super().__str__()}\nSTDOUT:\n{self.out}\nSTDERR:\n{self.err}"
+
+
+class TerraformDeployer(Terraform):
+    def __init__(
+        self,
+        parsed_args,
+        code_files,
+        config_files,
+        testing_ending=None,
+        code_hash=None,
+        cancellation=None,
+    ):
+        """
+        :param cancellation: :class:`threading.Event`: running terraform
+         command is stopped, once it's set
+        """
+        self.project_id = (
+            f"testing-{testing_ending}"
+            if testing_ending
+            else parsed_args.project_id
+        )
+
+        self.project_dir = SETTINGS.WORKING_DIR_BASE / self.project_id
+
+        # working directory should be unique for each deployment to prevent
+        # overlapping workspaces
+        self.working_dir = self.project_dir / parsed_args.cloud
+        self.testing_ending = testing_ending
+
+        os.makedirs(self.working_dir, exist_ok=True)
+
+        self.cancellation = cancellation
+        self._log = reporter.local.get_logger(
+            __name__, parsed_args.log_file, parsed_args.debug
+        )
+        self.state_cache = StateCache()
+        self._plans_changes = {}
+
+        # only files changed since previous run are written
+        with tracing.span("materialise"):
+            materialise(
+                self.project_dir,
+                chain(code_files, config_files),
+                parsed_args.cloud,
+            )
+
+        # terraform directory initialised for the same code is cloned from pool
+        self.code_hash = code_hash
+        self.cloud = parsed_args.cloud
+        self.pool = get_working_dir_pool() if code_hash else None
+        self._claimed = bool(self.pool) and self.pool.claim(
+            code_hash, self.cloud, self.working_dir
+        )
+
+        super(TerraformDeployer, self).__init__(working_dir=self.working_dir)
+
+        if not self._claimed:
+            # directory is pooled only after successful init
+            self._initialise(code_files)
+            if self.pool:
+                self.pool.add(code_hash, self.cloud, self.working_dir)
+
+        try:
+            self._create_workspace()
+            self.current_state = self.get_state()
+        except TerraformCommandError:
+            self._discard_claimed()
+            raise
+        self.previous_state = None
+
+    def command(self, command, *args, **kwargs):
+        self.state_cache.invalidate_after(command)
+        result = self.cmd(command, *args, **kwargs)
+        return_code, _, stderr = result
+        if return_code != 0 and INIT_REQUIRED_MESSAGE in stderr:
+            self._discard_claimed()
+        self._raise_if_bad_return_code(command, *result)
+        return result
+
+    def cmd(self, cmd, *args, **kwargs):
+        """
+        Runs terraform command, streaming its output to the log, instead of
+        collecting it in memory. Accepts the same options, as
+        :meth:`python_terraform.Terraform.cmd`, and also:
+        :param full_output: bool: whether complete stdout is returned,
+         otherwise only its tail is kept
+        :param timeout: float: seconds, command is stopped after, by default
+         it's taken from settings by name of command
+        :return: tuple: return code, stdout and stderr
+        """
+        full_output = kwargs.pop("full_output", False)
+        timeout = kwargs.pop("timeout", None) or _command_timeout(cmd)
+        raise_on_error = kwargs.pop("raise_on_error", False)
+        # output is always captured, and command is always synchronous
+        kwargs.pop("capture_output", None)
+        kwargs.pop("synchronous", None)
+
+        cmds = self.generate_cmd_string(cmd, *args, **kwargs)
+        try:
+            with tracing.span(_command_span_name(cmd)):
+                return_code, out, err = run_command(
+                    cmds,
+                    self._log,
+                    cwd=self.working_dir,
+                    env=os.environ.copy() if self.is_env_vars_included else {},
+                    timeout=timeout,
+                    cancellation=self.cancellation,
+                    capture_stdout=full_output,
+                    tail_lines=SETTINGS.TERRAFORM_OUTPUT_TAIL_LINES,
+                )
+        finally:
+            self.temp_var_files.clean_up()
+
+        if return_code == 0:
+            self.read_state_file()
+        elif raise_on_error:
+            raise TerraformCommandError(return_code, " ".join(cmds), out, err)
+        return return_code, out, err
+
+    def get_state(self):
+        """
+        Fetches the current state. Pull is skipped, if state was not changed
+        since previous one.
+        """
+        fingerprint = self._state_file_fingerprint()
+        state = self.state_cache.get(fingerprint)
+        if state is None:
+            result = self.command("state pull", full_output=True)
+            state = self.state_cache.update(result[1], fingerprint)
+        return state
+
+    def create_plan(self, destroy=False):
+        plan_file_name = "destroy_plan" if destroy else "plan"
+        # project dir is shared by deployers of all clouds
+        plan_path = self.working_dir / plan_file_name
+        skip_delete = "true" if self.testing_ending else "false"
+
+        plan_options = [
+            "-input=false",
+            "-detailed-exitcode",
+            f"-out={plan_path}",
+            f"-var=project_id={self.project_id}",
+            f"-var=project_name={self.project_id}",
+            f"-var=skip_delete={skip_delete}",
+        ]
+
+        if destroy:
+            plan_options.insert(0, "-destroy")
+
+        arguments = " ".join(plan_options)
+        return_code, _, _ = self.command(f"plan {arguments}")
+        self._plans_changes[plan_path] = (
+            return_code == PLAN_HAS_CHANGES_RETURN_CODE
+        )
+
+        return plan_path
+
+    def has_changes(self, plan):
+        """
+        Whether plan created by deployer changes anything. Plans created
+        elsewhere are considered as changing.
+        """
+        return self._plans_changes.get(plan, True)
+
+    def run(self, plan=False):
+        """
+        Creates plan (or accepts existing) and then runs `terraform apply` command.
+        Not using `Terraform.apply`, because it automatically passes `-var-file` argument,
+        while plan already contain all variables.
+        Apply is skipped, if plan has no changes.
+        """
+        state_before_apply = self.get_state()
+
+        plan = self.create_plan() if not plan else plan
+        if not self.has_changes(plan):
+            self.previous_state = state_before_apply
+            return
+
+        apply_options = [
+            "-no-color",
+            "-input=false",
+            "-auto-approve=false",
+            str(plan),
+        ]
+        apply_command = f"apply {' '.join(apply_options)}"
+        self.command(apply_command)
+
+        self.previous_state = state_before_apply
+        self.current_state = self.get_state()
+
+    def delete(self):
+        self.run(self.create_plan(destroy=True))
+
+    def _state_file_fingerprint(self):
+        """
+        Modification time and size of state file, if local backend is used.
+        """
+        state_file = (
+            self.working_dir
+            / "terraform.tfstate.d"
+            / self.project_id
+            / "terraform.tfstate"
+        )
+        try:
+            stat = state_file.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _initialise(self, code_files):
+        """
+        Runs `terraform init`, which also installs modules, reusing cached
+        providers and modules.
+        """
+        plugin_cache = get_plugin_cache()
+        code_key = self._code_digest(code_files)
+        if plugin_cache:
+            plugin_cache.restore(self.working_dir, code_key)
+
+        # providers and modules of failed init could be incomplete, so they are
+        # never cached
+        self.init(raise_on_error=True)
+
+        if plugin_cache:
+            plugin_cache.save(self.working_dir, code_key)
+
+    @staticmethod
+    def _code_digest(code_files):
+        """
+        Digest of code, providers and modules installed by terraform depend
+        on.
+        """
+        digest = hashlib.sha256()
+        for file_ in sorted(code_files, key=lambda file_: file_.path):
+            digest.update(file_.path.encode())
+            digest.update(file_sha(file_).encode())
+        return digest.hexdigest()
+
+    def _discard_claimed(self):
+        """
+        Removes broken directory, claimed from pool, from the pool, so next
+        deploys of the same code run `terraform init` again.
+        """
+        if self._claimed:
+            self.pool.invalidate(self.code_hash, self.cloud, self.working_dir)
+            self._claimed = False
+
+    @staticmethod
+    def _raise_if_bad_return_code(command, return_code, stdout, stderr):
+        if return_code == ERROR_RETURN_CODE:
+            raise TerraformCommandError(return_code, command, stdout, stderr)
+
+    def _create_workspace(self):
+        """
+        Selects workspace, or creates it, if it's not exists. New workspace is
+        selected by terraform automatically.
+        """
+        return_code, _, _ = self.cmd(f"workspace select {self.project_id}")
+        if return_code != 0:
+            self.command(f"workspace new {self.project_id}")
+
+
+def _command_span_name(command):
+    """
+    Name of span of terraform command, like "terraform_plan" or
+    "terraform_state_pull".
+    """
+    words = [word for word in command.split()[:2] if not word.startswith("-")]
+    if len(words) == 2 and words[0] not in ("state", "workspace"):
+        words = words[:1]
+    return "_".join(["terraform"] + words)
+
+
+def _command_timeout(command):
+    """
+    Timeout of terraform command from settings.
+    """
+    name = command.split()[0] if command.split() else ""
+    return SETTINGS.TERRAFORM_COMMAND_TIMEOUTS.get(
+        name, SETTINGS.TERRAFORM_COMMAND_TIMEOUT
+    )
@@ -1 +1,3 @@
-from . import stackdriver, local, slack, zabbix
+# submodules are imported where they are used: stackdriver pulls in google
+# cloud libraries, which are slow to import, and it's only needed when
+# metrics are sent
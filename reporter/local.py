@@ -1,9 +1,32 @@
 import logging
+import os
+import threading
 from sys import stdout
 
+_configure_lock = threading.Lock()
+
 
 def get_logger(module_name: str, log_file: str, debug: bool = False):
+    """
+    Returns logger, which writes to log file. Logger is configured once, so
+    it could be requested by every instance of a class without duplicating
+    handlers.
+    """
     logger = logging.getLogger(module_name)
+    with _configure_lock:
+        if not _has_file_handler(logger, log_file):
+            _configure(logger, log_file, debug)
+    return logger
+
+
+def _has_file_handler(logger, log_file):
+    return any(
+        getattr(handler, "baseFilename", None) == os.path.abspath(log_file)
+        for handler in logger.handlers
+    )
+
+
+def _configure(logger, log_file, debug):
     logger.setLevel(logging.INFO)
     file_stream = logging.FileHandler(log_file)
 
@@ -18,5 +41,3 @@ def get_logger(module_name: str, log_file: str, debug: bool = False):
         debug_stream.setFormatter(fmt)
         logger.addHandler(debug_stream)
         logger.setLevel(logging.DEBUG)
-
-    return logger
@@ -8,6 +8,9 @@ from google.auth.credentials import Credentials
 
 from google.cloud.monitoring_v3.types import TimeSeries
 
+# limit of time series in one `create_time_series` request
+MAX_TIME_SERIES_PER_REQUEST = 200
+
 
 class SerializationException(Exception):
     pass
@@ -190,6 +193,7 @@ class AppMetrics(Metrics):
         super().__init__(**kwargs)
         self._start_time = datetime.utcnow()
         self._end_time = None
+        self._created_descriptors = set()
 
     def initialize_base_metrics_message(
         self,
@@ -200,7 +204,8 @@ class AppMetrics(Metrics):
         unit=None,
     ) -> TimeSeries:
         """
-        creates an TimeSeries metrics object called metric_name and with labels
+        creates an TimeSeries metrics object called metric_name and with labels.
+        Metric descriptor is created only once for every metric name.
         :param metric_name: name to call custom metric. As in custom.googleapis.com/ + metric_name
         :param labels: metric labels to add
         :param metric_kind: the kind of measurement. It describes how the data is reported
@@ -216,14 +221,16 @@ class AppMetrics(Metrics):
         if unit is not None:
             metric_descriptor_values["unit"] = unit
 
-        self.metrics_client.create_metric_descriptor(
-            name=self.monitoring_project_path,
-            metric_descriptor=MetricDescriptor(**metric_descriptor_values),
-        )
+        if metric_name not in self._created_descriptors:
+            self.metrics_client.create_metric_descriptor(
+                name=self.monitoring_project_path,
+                metric_descriptor=MetricDescriptor(**metric_descriptor_values),
+            )
+            self._created_descriptors.add(metric_name)
 
-        # if we send requests through metrics_client one after another, we receive unclear error 500,
-        # probably due to google's requests throttling
-        sleep(1)
+            # if we send requests through metrics_client one after another, we receive unclear error 500,
+            # probably due to google's requests throttling
+            sleep(1)
 
         series = self.metrics_type(
             metric_kind=metric_kind, value_type=value_type
@@ -277,9 +284,21 @@ class AppMetrics(Metrics):
 
             time_series_list.append(time_series)
 
-        self.metrics_client.create_time_series(
-            self.monitoring_project_path, time_series_list
-        )
+        for start in range(
+            0, len(time_series_list), MAX_TIME_SERIES_PER_REQUEST
+        ):
+            self.metrics_client.create_time_series(
+                self.monitoring_project_path,
+                time_series_list[start : start + MAX_TIME_SERIES_PER_REQUEST],
+            )
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+    @start_time.setter
+    def start_time(self, value):
+        self._start_time = value
 
     @property
     def end_time(self):
@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+# separator of names of nested spans in phase path
+PATH_SEPARATOR = "/"
+
+Span = namedtuple("Span", ["path", "labels", "duration"])
+
+
+class SpanRecorder:
+    """
+    Collects finished spans, writes them to the log as structured lines, and
+    converts them to metrics for :class:`reporter.stackdriver.AppMetrics`.
+    """
+
+    def __init__(self, logger=None):
+        self.spans = []
+        self._log = logger
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+        if self._log:
+            self._log.info(
+                json.dumps(
+                    {
+                        "phase": span.path,
+                        "duration": round(span.duration, 3),
+                        **span.labels,
+                    },
+                    sort_keys=True,
+                )
+            )
+
+    def metrics(
+        self, metric_name="phase_time", max_depth=None, aggregated_labels=()
+    ):
+        """
+        Sums durations of spans with the same path and labels, since the same
+        phase could run many times, like terraform commands.
+        :param max_depth: int: spans nested deeper are not reported
+        :param aggregated_labels: iterable: names of labels, which are
+         dropped, so durations are summed across their values, like projects
+        :return: list: of metrics sets, accepted by
+         :attr:`reporter.stackdriver.Metrics.metrics_set_list`
+        """
+        durations = OrderedDict()
+        with self._lock:
+            for span in self.spans:
+                depth = span.path.count(PATH_SEPARATOR) + 1
+                if max_depth is not None and depth > max_depth:
+                    continue
+                labels = sorted(
+                    (name, value)
+                    for name, value in span.labels.items()
+                    if name not in aggregated_labels
+                )
+                key = (span.path, tuple(labels))
+                durations[key] = durations.get(key, 0) + span.duration
+
+        return [
+            {
+                "metric_name": metric_name,
+                "labels": {"phase": path, **dict(labels)},
+                "metric_kind": "gauge",
+                "value_type": "double",
+                "value": duration,
+            }
+            for (path, labels), duration in durations.items()
+        ]
+
+
+class _ActiveSpan:
+    def __init__(self, recorder, name, labels):
+        self._recorder = recorder
+        self._name = name
+        self._labels = labels
+        self._start = None
+        self._parent = None
+
+    def __enter__(self):
+        self._parent = getattr(_context, "span", None)
+        if self._parent:
+            self.path = self._parent.path + PATH_SEPARATOR + self._name
+            self.labels = {**self._parent.labels, **self._labels}
+        else:
+            self.path = self._name
+            self.labels = self._labels
+        _context.span = self
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.monotonic() - self._start
+        _context.span = self._parent
+        self._recorder.record(Span(self.path, self.labels, duration))
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+_recorder = None
+_context = threading.local()
+
+
+def enable(logger=None):
+    """
+    Starts recording of spans.
+    :param logger: :class:`logging.Logger`: which receives finished spans
+    :return: :class:`SpanRecorder`
+    """
+    global _recorder
+    _recorder = SpanRecorder(logger)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+def span(name, **labels):
+    """
+    Measures duration of the phase, when used as context manager. Spans
+    started inside another one are nested in it: their path includes names
+    of outer spans, and they inherit its labels. When recording is disabled,
+    shared no-op span is returned.
+    :param name: string: name of the phase
+    :param labels: strings: which describe the phase, like cloud or project
+    """
+    if _recorder is None:
+        return _NO_SPAN
+    return _ActiveSpan(_recorder, name, labels)
+
+
+def traced(name):
+    """
+    Decorator, which measures duration of every call of function.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(function):
+    """
+    Wraps function, so spans started by it in another thread are nested in
+    the span, which is current in the calling thread.
+    """
+    parent = getattr(_context, "span", None)
+    if _recorder is None or parent is None:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_context, "span", None)
+        _context.span = parent
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _context.span = previous
+
+    return wrapper
@@ -0,0 +1,66 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from reporter import tracing
+
+TaskResult = namedtuple("TaskResult", ["name", "result", "error", "duration"])
+
+
+def run_concurrently(tasks, workers, thread_name_prefix="worker"):
+    """
+    Runs tasks in pool of bounded number of threads. Failure of some task
+    doesn't stop others, it's recorded in task result instead. Phases of
+    tasks are nested in the current span of calling thread.
+    :param tasks: list: of (name, callable) tuples
+    :param workers: int: maximal number of tasks running at the same time
+    :param thread_name_prefix: string: prefix of workers names used in logs
+    :return: list: of :class:`TaskResult`, in the same order as tasks
+    """
+
+    def run(name, task):
+        start = time.monotonic()
+        try:
+            result, error = task(), None
+        except Exception as e:
+            result, error = None, e
+        return TaskResult(name, result, error, time.monotonic() - start)
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix=thread_name_prefix
+    ) as executor:
+        futures = [
+            executor.submit(run, name, tracing.propagate(task))
+            for name, task in tasks
+        ]
+        return [future.result() for future in futures]
+
+
+def format_summary(results, result_label=str):
+    """
+    Formats results of tasks as a table.
+    :param results: list: of :class:`TaskResult`
+    :param result_label: function: which formats result of successful task
+    :return: string
+    """
+    rows = [("NAME", "RESULT", "TIME, S", "ERROR")]
+    for task_result in results:
+        failed = task_result.error is not None
+        rows.append(
+            (
+                task_result.name,
+                "failure" if failed else result_label(task_result.result),
+                f"{task_result.duration:.1f}",
+                repr(task_result.error) if failed else "",
+            )
+        )
+    widths = [max(len(row[column]) for row in rows) for column in range(3)]
+    lines = [
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+        + "  "
+        + row[3]
+        for row in rows
+    ]
+    failures = sum(task_result.error is not None for task_result in results)
+    lines.append(f"{len(results)} total, {failures} failed")
+    return "\n".join(line.rstrip() for line in lines)
@@ -1,6 +1,7 @@
 from importlib import import_module
 
 from . import default_settings
+from .lazy import LazySetting
 
 
 class BaseSettings:
@@ -62,7 +63,11 @@ class BaseSettings:
     def get(self, key, default_value=None):
         if not key.isupper():
             return None
-        return self.attributes.get(key, default_value)
+        value = self.attributes.get(key, default_value)
+        if isinstance(value, LazySetting):
+            value = value.function()
+            self.attributes[key] = value
+        return value
 
     def set(self, key, value):
         if key.isupper():
@@ -3,6 +3,8 @@ import json
 
 from pathlib import Path
 
+from .lazy import LazySetting
+
 # ############## Common settings #############
 DEFAULT_LOG_FILE = "/var/log/enterprise_cloud_admin.log"
 MODULE_ROOT_DIR = Path(__file__).resolve().parent.parent
@@ -18,15 +20,40 @@ PROJECT_DATA_DIR = (
 )
 DEFAULT_TOKEN_FILE = MODULE_ROOT_DIR / "/resources/token.json"
 DEFAULT_GIT_REF = "master"
-DEFAULT_TOKEN = (
-    json.load(open(DEFAULT_TOKEN_FILE))["token"]
-    if os.path.exists(DEFAULT_TOKEN_FILE)
-    else ""
-)
+
+
+def _read_default_token():
+    if not os.path.exists(DEFAULT_TOKEN_FILE):
+        return ""
+    with open(DEFAULT_TOKEN_FILE) as token_file:
+        return json.load(token_file)["token"]
+
+
+DEFAULT_TOKEN = LazySetting(_read_default_token)
 SUPPORTED_CLOUDS = ["aws", "gcp", "triton"]
 SUPPORTED_VCS_PLATFORMS = ["github"]
 SUPPORTED_ORCHESTRATORS = ["terraform"]
 VALID_PROJECT_ID_FORMAT = "^[a-z]{4}-[a-z0-9]{4,31}-(?:dev|prod|test)$"
+# number of queued projects processed concurrently
+DEFAULT_WORKERS = 4
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+PROJECTS_QUEUE_TABLE = "projects_queue"
+# "contents" requests files of directory one by one, "archive" downloads
+# tarball of repository once and extracts requested directory recursively,
+# "mirror" reads files and commits from local bare clone of repository, which
+# is fetched incrementally once per run
+GITHUB_FETCH_MODE = "contents"
+GITHUB_ARCHIVE_TIMEOUT = 60  # seconds
+# pace of requests to GitHub API sent with the same token
+GITHUB_REQUESTS_PER_SECOND = 10
+GITHUB_REQUESTS_BURST = 20
+# part of hourly quota, below which remaining requests are spread evenly
+# until reset of the limit
+GITHUB_RATE_LIMIT_RESERVE = 0.1
+# retries of requests rejected by rate limits
+GITHUB_RATE_LIMIT_RETRIES = 5
+GITHUB_RETRY_BACKOFF = 1  # seconds, doubled on every retry
+GITHUB_RETRY_MAX_BACKOFF = 60  # seconds
 
 
 # ############## Code control settings ##############
@@ -74,7 +101,54 @@ REMOTE_FILES = {
 
 # ############## Deployer settings ##############
 WORKING_DIR_BASE = Path("/tmp")
+# Caches below are shared by all users of the host, so they are disabled by
+# default, empty value disables each of them. They could be enabled with
+# private directory, like Path.home() / ".cache/project_factory".
+# providers and modules cache shared by all working directories, like
+# WORKING_DIR_BASE / "terraform_plugin_cache"
+TERRAFORM_PLUGIN_CACHE_DIR = ""
+TERRAFORM_PLUGIN_CACHE_MAX_SIZE = 2 * 1024 ** 3  # bytes
+# working directories initialised for recent code commits, like
+# WORKING_DIR_BASE / "terraform_working_dir_pool", zero size also disables
+# the pool
+WORKING_DIR_POOL_DIR = ""
+WORKING_DIR_POOL_SIZE = 5
+# combinations of code and config commits, which passed test deployment, like
+# WORKING_DIR_BASE / "validation_ledger.sqlite"
+VALIDATION_LEDGER_FILE = ""
+VALIDATION_LEDGER_TTL = 7 * 24 * 60 * 60  # seconds
+# files of repositories by git blob sha, shared by all projects in "archive"
+# fetch mode, like WORKING_DIR_BASE / "github_blob_cache"
+GITHUB_BLOB_CACHE_DIR = ""
+GITHUB_BLOB_CACHE_MAX_SIZE = 512 * 1024 ** 2  # bytes
+# if more blobs are missing in cache, tarball of repository is downloaded
+# instead of requesting them one by one
+GITHUB_BLOB_FETCH_LIMIT = 10
+# bare clones of repositories used in "mirror" fetch mode, which requires
+# git 2.9 or newer
+GITHUB_MIRROR_DIR = WORKING_DIR_BASE / "github_mirrors"
+# responses of GitHub API revalidated by ETag, like
+# WORKING_DIR_BASE / "github_http_cache.sqlite"
+GITHUB_HTTP_CACHE_FILE = ""
+GITHUB_HTTP_CACHE_MAX_ENTRIES = 10000
+# seconds, terraform commands are stopped after, by name of command
+TERRAFORM_COMMAND_TIMEOUTS = {
+    "init": 15 * 60,
+    "plan": 30 * 60,
+    "apply": 2 * 60 * 60,
+}
+TERRAFORM_COMMAND_TIMEOUT = 10 * 60  # seconds, for other commands
+# number of last lines of terraform output kept for error reports
+TERRAFORM_OUTPUT_TAIL_LINES = 200
 
 
 # ############## Reporter settings ##############
 DEFAULT_MONITORING_PROJECT = "gb-me-services"
+# durations of phases are logged and sent as metrics
+TRACING_ENABLED = True
+# phases nested deeper are only logged, since every metric is sent separately
+TRACING_METRICS_DEPTH = 2
+# labels of phases, which are not sent as metrics labels, so durations of
+# phases are summed across them, and number of metrics doesn't grow with
+# number of projects
+TRACING_METRICS_AGGREGATED_LABELS = ("project", "repo")
@@ -0,0 +1,11 @@
+class LazySetting:
+    """
+    Value of setting, which is computed on first access, so settings which
+    need file I/O don't slow down import of settings.
+    """
+
+    def __init__(self, function):
+        """
+        :param function: callable: without arguments, which returns value
+        """
+        self.function = function
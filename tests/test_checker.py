@@ -0,0 +1,8 @@
+import checker
+
+
+def test_all_runs_every_cloud_checker(mocker):
+    for cloud in ("aws", "gcp", "triton"):
+        mocker.patch(f"checker.{cloud}", return_value=cloud)
+
+    assert checker.all_([]) == {"aws": "aws", "gcp": "gcp", "triton": "triton"}
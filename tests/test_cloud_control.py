@@ -1,14 +1,18 @@
+import hashlib
+from copy import copy
+from threading import Barrier
 from uuid import uuid4
 
 import pytest
 
 from cloud_control import ArgumentsParser, CloudControl, CloudControlException
+from settings import SETTINGS
 
 
 @pytest.fixture
 def app_metrics_mock(mocker):
     mocker.patch("cloud_control.common.GcpAuth")
-    return mocker.patch("cloud_control.reporter.stackdriver.AppMetrics")
+    return mocker.patch("reporter.stackdriver.AppMetrics")
 
 
 def test_deploy(
@@ -25,15 +29,110 @@ def test_deploy(
     cloud_control = CloudControl(command_line_args)
 
     cloud_control.perform_command()
-    deploy.assert_called_once_with(
-        command_line_args,
+    deploy.assert_called_once()
+    args, *fetched = deploy.call_args[0]
+    # files and hashes are passed as futures, while they are being fetched
+    assert args is command_line_args
+    project_digest = hashlib.sha256(
+        command_line_args.project_id.encode()
+    ).hexdigest()
+    assert [future.result() for future in fetched] == [
         common.get_files(),
         common.get_files(),
-        short_code_config_hash,
+        f"{short_code_config_hash}-{project_digest[:6]}",
+        sha256_hash,
+        sha256_hash,
+    ]
+    common.get_files.assert_any_call(
+        common.get_org(),
+        command_line_args.code_repo,
+        command_line_args.cloud,
+        command_line_args.code_version,
     )
     app_metrics_mock.return_value.send_metrics.assert_called_once()
 
 
+@pytest.mark.parametrize(
+    "command_result, label",
+    [(True, "success"), (False, "failure"), ("no_changes", "no_changes")],
+)
+def test_result_label(command_result, label):
+    assert CloudControl._result_label(command_result) == label
+
+
+def test_deploy_queued_projects(mocker, command_line_args, app_metrics_mock):
+    """
+    Every queued project is deployed with own arguments, and failure of one
+    of them doesn't stop others.
+    """
+    deployed_projects = []
+
+    def deploy_project(args):
+        deployed_projects.append(args.project_id)
+        if args.project_id == "failed-project":
+            raise CloudControlException("deployment failed")
+        return "success"
+
+    args = copy(command_line_args)
+    args.projects_list = ["some-project", "failed-project"]
+    args.workers = 2
+    cloud_control = CloudControl(args)
+    mocker.patch.object(cloud_control, "_deploy_project", deploy_project)
+
+    assert cloud_control._deploy() is False
+    assert sorted(deployed_projects) == ["failed-project", "some-project"]
+    assert args.project_id not in deployed_projects
+
+
+def test_queued_projects_get_own_test_deployments(
+    mocker, command_line_args, sha256_hash, app_metrics_mock
+):
+    """
+    Projects with the same code and config commits, deployed at the same
+    time, shouldn't share test project and its workspace.
+    """
+    deploy = mocker.patch("cloud_control.deploy")
+    common = mocker.patch("cloud_control.common")
+    common.get_hash_of_latest_commit.return_value = sha256_hash
+    args = copy(command_line_args)
+    args.projects_list = ["abcd-first-dev", "abcd-second-dev"]
+    args.workers = 2
+
+    CloudControl(args)._deploy()
+
+    test_projects = {
+        call_args[0][0].project_id: call_args[0][3].result()
+        for call_args in deploy.call_args_list
+    }
+    assert sorted(test_projects) == args.projects_list
+    assert len(set(test_projects.values())) == 2
+    for ending in test_projects.values():
+        assert len(f"testing-{ending}") <= 30
+
+
+def test_deploy_all_clouds(mocker, command_line_args, app_metrics_mock):
+    """
+    Deployment to all clouds is split into concurrent deployment per cloud.
+    """
+    started = Barrier(len(SETTINGS.SUPPORTED_CLOUDS), timeout=5)
+    deployed_clouds = []
+
+    def deploy_project(args):
+        # fails, unless deployments to all clouds run at the same time
+        started.wait()
+        deployed_clouds.append(args.cloud)
+        return "no_changes"
+
+    args = copy(command_line_args)
+    args.cloud = "all"
+    cloud_control = CloudControl(args)
+    mocker.patch.object(cloud_control, "_deploy_project", deploy_project)
+
+    assert cloud_control._deploy() == "no_changes"
+    assert sorted(deployed_clouds) == sorted(SETTINGS.SUPPORTED_CLOUDS)
+    assert args.cloud == "all"
+
+
 def test_config(mocker, command_line_args, app_metrics_mock):
     setup = mocker.patch("cloud_control.setup")
 
@@ -46,6 +145,37 @@ def test_config(mocker, command_line_args, app_metrics_mock):
     app_metrics_mock.return_value.send_metrics.assert_called_once()
 
 
+def test_config_queued_projects(mocker, command_line_args, app_metrics_mock):
+    """
+    Queued projects are configured concurrently, and invalid project id or
+    exit of one of setups doesn't stop others.
+    """
+    configured_projects = []
+
+    def setup(args):
+        configured_projects.append(args.config_repo)
+        if args.project_id == "abcd-existing-test":
+            exit(1)
+        return True
+
+    mocker.patch("cloud_control.setup", setup)
+    args = copy(command_line_args)
+    args.command = "config"
+    args.config_repo = None
+    args.projects_list = [
+        "abcd-fresh-dev",
+        "abcd-existing-test",
+        "invalid-project",
+    ]
+    cloud_control = CloudControl(args)
+
+    assert cloud_control._config() is False
+    assert sorted(configured_projects) == [
+        "abcd-existing-test",
+        "abcd-fresh-dev",
+    ]
+
+
 @pytest.mark.usefixtures("app_metrics_mock")
 def test_perform_command_exception(command_line_args):
     command_line_args.command = str(uuid4())
@@ -106,4 +236,6 @@ def test_argument_parser_defaults(tmpdir):
         "command": "deploy",
         "force": False,
         "cloud": "gcp",
+        "revalidate": False,
+        "workers": 4,
     }
@@ -0,0 +1,267 @@
+import json
+from argparse import Namespace
+from unittest.mock import MagicMock, Mock
+
+import pytest
+from github import GithubException, UnknownObjectException
+
+from code_control import (
+    GithubFileExists,
+    plan_changes,
+    update_repo_files,
+    write_project_data,
+)
+from common.cache import git_blob_digest
+from settings import SETTINGS
+
+FILES = {
+    "project.tf": "project",
+    "iam.auto.tfvars.json": "{}",
+    "enabled_apis.auto.tfvars.json": "[]",
+}
+
+
+@pytest.fixture
+def repo():
+    repo = MagicMock()
+    repo.get_git_tree.return_value.raw_data = {"truncated": False}
+    repo.get_git_tree.return_value.tree = [Mock(path="project.tf")]
+    return repo
+
+
+def test_update_repo_files_makes_one_commit(repo):
+    update_repo_files(repo, FILES, "Update ", force=True)
+
+    (elements, base_tree), _ = repo.create_git_tree.call_args
+    assert sorted(element._identity["path"] for element in elements) == sorted(
+        FILES
+    )
+    base_commit = repo.get_git_commit.return_value
+    assert base_tree is base_commit.tree
+    repo.create_git_commit.assert_called_once_with(
+        "Update " + ", ".join(FILES),
+        repo.create_git_tree.return_value,
+        [base_commit],
+    )
+    repo.get_git_ref.return_value.edit.assert_called_once_with(
+        repo.create_git_commit.return_value.sha
+    )
+    repo.create_file.assert_not_called()
+    repo.update_file.assert_not_called()
+
+
+def test_update_repo_files_refuses_to_overwrite(repo):
+    with pytest.raises(GithubFileExists):
+        update_repo_files(repo, FILES, "Update")
+    repo.create_git_commit.assert_not_called()
+
+
+def test_update_repo_files_bypasses_branch_protection(repo):
+    ref = repo.get_git_ref.return_value
+    ref.edit.side_effect = [GithubException(422, {}, None), None]
+
+    update_repo_files(repo, FILES, "Update", force=True, bypass_protection=True)
+
+    repo.get_branch.return_value.remove_protection.assert_called_once()
+    assert ref.edit.call_count == 2
+
+
+def test_update_repo_files_initialises_empty_repo(repo):
+    repo.get_git_ref.side_effect = [
+        GithubException(409, {"message": "Git Repository is empty."}, None),
+        MagicMock(),
+    ]
+
+    update_repo_files(repo, FILES, "Initial commit", force=True)
+
+    repo.create_file.assert_called_once_with(
+        "project.tf", "Initial commit", "project", branch="master"
+    )
+    (elements, _), _ = repo.create_git_tree.call_args
+    assert len(elements) == 2
+
+
+def test_update_repo_files_skips_unchanged_files(repo):
+    repo.get_git_tree.return_value.tree = [
+        Mock(path="project.tf", sha=git_blob_digest(b"project")),
+        Mock(path="iam.auto.tfvars.json", sha=git_blob_digest(b"old")),
+    ]
+
+    update_repo_files(repo, FILES, "Update ", force=True)
+
+    (elements, _), _ = repo.create_git_tree.call_args
+    assert sorted(element._identity["path"] for element in elements) == [
+        "enabled_apis.auto.tfvars.json",
+        "iam.auto.tfvars.json",
+    ]
+
+    repo.reset_mock()
+    repo.get_git_tree.return_value.tree = [
+        Mock(path=path, sha=git_blob_digest(content.encode()))
+        for path, content in FILES.items()
+    ]
+    update_repo_files(repo, FILES, "Update ", force=True)
+    repo.create_git_tree.assert_not_called()
+    repo.create_git_commit.assert_not_called()
+
+
+def test_update_repo_files_walks_truncated_tree(repo):
+    files = {"gcp/project.tf": "project", "README.md": "readme"}
+    trees = {
+        "root": [
+            Mock(path="README.md", type="blob", sha=git_blob_digest(b"old")),
+            Mock(path="gcp", type="tree", sha="gcp"),
+            Mock(path="aws", type="tree", sha="aws"),
+        ],
+        "gcp": [
+            Mock(
+                path="project.tf", type="blob", sha=git_blob_digest(b"project")
+            )
+        ],
+    }
+
+    def get_git_tree(sha, recursive=False):
+        if recursive:
+            return Mock(raw_data={"truncated": True}, tree=[])
+        return Mock(tree=trees[sha])
+
+    repo.get_git_commit.return_value.tree.sha = "root"
+    repo.get_git_tree.side_effect = get_git_tree
+
+    assert update_repo_files(repo, files, "Update ", force=True) == [
+        "README.md"
+    ]
+    # only subtrees with files being written are listed
+    assert "aws" not in [
+        args[0] for args, _ in repo.get_git_tree.call_args_list
+    ]
+
+
+@pytest.fixture
+def configured_org(mocker):
+    std = SETTINGS.STANDARD_TEAM_ATTRIBUTES
+    priv = SETTINGS.PRIV_TEAM_ATTRIBUTES
+    teams = {
+        std["name"]: Mock(
+            slug=std["name"],
+            permission=std["permission"],
+            privacy=std["privacy"],
+            description=std["description"],
+        ),
+        priv["name"]: Mock(
+            slug=priv["name"],
+            permission=priv["permission"],
+            privacy=std["privacy"],
+            description=priv["description"],
+        ),
+    }
+    # parent is reserved argument of Mock
+    teams[std["name"]].parent = None
+    teams[priv["name"]].parent = Mock(slug=std["name"])
+
+    def get_team_by_slug(slug):
+        if slug not in teams:
+            raise UnknownObjectException(404, {}, None)
+        return teams[slug]
+
+    org = MagicMock()
+    org.get_team_by_slug.side_effect = get_team_by_slug
+    return org
+
+
+@pytest.fixture
+def configured_repo():
+    repo = MagicMock(private=True)
+    repo.get_teams.return_value = [
+        Mock(slug=SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"], permission="pull"),
+        Mock(slug=SETTINGS.PRIV_TEAM_ATTRIBUTES["name"], permission="push"),
+    ]
+    protection = repo.get_branch.return_value.get_protection.return_value
+    protection.enforce_admins = True
+    reviews = protection.required_pull_request_reviews
+    reviews.dismiss_stale_reviews = True
+    reviews.require_code_owner_reviews = False
+    reviews.required_approving_review_count = 1
+    return repo
+
+
+def test_plan_of_configured_project_is_empty(configured_org, configured_repo):
+    args = Namespace(
+        vcs_token="token", branch_permissions=SETTINGS.PROTECTED_BRANCH
+    )
+
+    assert plan_changes(configured_org, configured_repo, args) == []
+
+
+def test_plan_applies_only_changes(mocker, configured_org, configured_repo):
+    configure_remote_object = mocker.patch(
+        "code_control.configure_remote_object"
+    )
+    configured_repo.private = False
+    args = Namespace(
+        vcs_token="token", branch_permissions=SETTINGS.HIGHLY_PROTECTED_BRANCH
+    )
+    std_team = configured_org.get_team_by_slug(
+        SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"]
+    )
+    std_team.description = "outdated"
+
+    changes = plan_changes(configured_org, configured_repo, args)
+
+    assert [(change.resource, change.attribute) for change in changes] == [
+        ("team " + std_team.slug, "description"),
+        ("repository", "private"),
+        ("branch master", "protection"),
+    ]
+    for change in changes:
+        change.apply()
+    configure_remote_object.assert_called_once_with(
+        std_team.url,
+        "token",
+        description=SETTINGS.STANDARD_TEAM_ATTRIBUTES["description"],
+    )
+    configured_repo.edit.assert_called_once_with(private=True)
+    configured_repo.get_branch.return_value.edit_protection.assert_called_once_with(
+        **SETTINGS.HIGHLY_PROTECTED_BRANCH
+    )
+
+
+def test_plan_of_new_project_creates_everything():
+    org = MagicMock()
+    org.get_team_by_slug.side_effect = UnknownObjectException(404, {}, None)
+    args = Namespace(
+        vcs_token="token", branch_permissions=SETTINGS.PROTECTED_BRANCH
+    )
+
+    changes = plan_changes(org, None, args)
+
+    std_name = SETTINGS.STANDARD_TEAM_ATTRIBUTES["name"]
+    priv_name = SETTINGS.PRIV_TEAM_ATTRIBUTES["name"]
+    assert [(change.resource, change.attribute) for change in changes] == [
+        ("team " + std_name, "exists"),
+        ("team " + std_name, "description"),
+        ("team " + priv_name, "exists"),
+        ("team " + priv_name, "description"),
+        ("team " + priv_name, "parent"),
+        ("repository", "private"),
+        ("repository team " + std_name, "permission"),
+        ("repository team " + priv_name, "permission"),
+        ("branch master", "protection"),
+    ]
+
+
+def test_write_project_data_per_project(tmp_path):
+    team = Mock(slug="devs", raw_data={"slug": "devs"})
+    for name in ("abcd-one-dev", "abcd-two-dev"):
+        repo = Mock(raw_data={"name": name})
+        repo.name = name
+        write_project_data(repo, [team], tmp_path)
+    # directory exists already, when the same project is configured again
+    write_project_data(repo, [team], tmp_path)
+
+    for name in ("abcd-one-dev", "abcd-two-dev"):
+        project_dir = tmp_path / name
+        assert json.loads((project_dir / "repo.json").read_text()) == {
+            "name": name
+        }
+        assert (project_dir / "team_devs.json").exists()
@@ -0,0 +1,470 @@
+import io
+import os
+import sqlite3
+import subprocess
+import tarfile
+import threading
+import time
+from argparse import Namespace
+from base64 import b64encode
+from contextlib import closing
+from unittest.mock import Mock
+
+import pytest
+
+from github import UnknownObjectException
+
+from common import (
+    read_projects_queue,
+    get_org,
+    get_repo,
+    get_team,
+    get_team_by_id,
+    index_team,
+)
+from common.archive import extract_directory, fetch_directory, RepoFile
+from common.blobs import fetch_directory_cached
+from common import rate_limit
+from common.clients import clear_github_clients, fetch_team_by_slug
+from common.mirror import get_mirror, RepoMirror
+from common.http_cache import HTTPSConnection, ResponseCache
+from settings import SETTINGS
+from common.cache import ContentStore, sha256_digest, git_blob_digest
+
+
+def test_content_store_put_get(tmpdir):
+    store = ContentStore(tmpdir.strpath)
+
+    key = store.put(b"content")
+
+    assert key == sha256_digest(b"content")
+    assert store.get(key) == b"content"
+    assert store.get(sha256_digest(b"missing")) is None
+    assert store.stats == {"hits": 1, "misses": 1}
+
+
+def test_content_store_evicts_least_recently_used(tmpdir):
+    """
+    When storage exceeds its size, least recently used blobs are removed.
+    """
+    store = ContentStore(tmpdir.strpath, max_size=10)
+    old_key = store.put(b"a" * 6)
+    new_key = store.put(b"b" * 6)
+    past = time.time() - 60
+    os.utime(store.path(old_key), (past, past))
+
+    store.evict()
+
+    assert old_key not in store
+    assert new_key in store
+    assert store.size() == 6
+
+
+def test_read_projects_queue_from_text_file(tmpdir):
+    queue = tmpdir.join("queue.txt")
+    queue.write(
+        "# queued projects\nsome-project\n\nother-project\nsome-project\n"
+    )
+
+    assert read_projects_queue(queue.strpath) == [
+        "some-project",
+        "other-project",
+    ]
+
+
+def test_read_projects_queue_from_sqlite(tmpdir):
+    queue = tmpdir.join("queue.db").strpath
+    with closing(sqlite3.connect(queue)) as db:
+        with db:
+            db.execute("CREATE TABLE projects_queue (project_id TEXT)")
+            db.executemany(
+                "INSERT INTO projects_queue VALUES (?)",
+                [("some-project",), ("other-project",)],
+            )
+
+    assert read_projects_queue(queue) == ["some-project", "other-project"]
+
+
+def test_github_clients_are_shared(mocker):
+    github = mocker.patch("github.Github")
+    clear_github_clients()
+    args = Namespace(api_url="https://api.github.com", vcs_token="token")
+
+    org = get_org(args, "some-org")
+
+    assert get_org(args, "some-org") is org
+    assert get_repo(org, "some-repo") is get_repo(org, "some-repo")
+    github.assert_called_once_with(
+        base_url="https://api.github.com", login_or_token="token"
+    )
+    github.return_value.get_organization.assert_called_once_with("some-org")
+    org.get_repo.assert_called_once_with("some-repo")
+
+    other_args = Namespace(api_url="https://api.github.com", vcs_token="other")
+    get_org(other_args, "some-org")
+    assert github.call_count == 2
+    clear_github_clients()
+
+
+def test_teams_are_indexed(mocker):
+    mocker.patch("github.Github")
+    clear_github_clients()
+    args = Namespace(api_url="https://api.github.com", vcs_token="token")
+    org = get_org(args, "some-org")
+    org.get_team_by_slug.side_effect = UnknownObjectException(404, {}, None)
+
+    assert get_team(org, "new-team") is None
+    assert get_team(org, "new-team") is None
+    org.get_team_by_slug.assert_called_once_with("new-team")
+
+    created = mocker.MagicMock(slug="new-team", id=42)
+    index_team(org, created, "new-team")
+    assert get_team(org, "new-team") is created
+    assert get_team_by_id(org, 42) is created
+    org.get_team.assert_not_called()
+    org.get_teams.assert_not_called()
+
+
+def test_team_is_fetched_by_slug_without_method_of_old_pygithub():
+    org = Mock(spec=["url", "_requester"], url="https://api/orgs/some-org")
+    org._requester.requestJsonAndCheck.return_value = (
+        {},
+        {"slug": "devs", "id": 42},
+    )
+
+    team = fetch_team_by_slug(org, "devs")
+
+    org._requester.requestJsonAndCheck.assert_called_once_with(
+        "GET", "https://api/orgs/some-org/teams/devs"
+    )
+    assert team.id == 42
+
+    org._requester.requestJsonAndCheck.side_effect = UnknownObjectException(
+        404, {}, None
+    )
+    assert fetch_team_by_slug(org, "unknown") is None
+    clear_github_clients()
+
+
+@pytest.fixture
+def repo_tarball():
+    """
+    Gzipped tarball in the format of GitHub archive.
+    """
+    archive_file = io.BytesIO()
+    with tarfile.open(fileobj=archive_file, mode="w:gz") as archive:
+        for path, content in [
+            ("gcp/project.tf", b"project"),
+            ("gcp/modules/network/main.tf", b"network"),
+            ("aws/project.tf", b"aws"),
+            ("README.md", b"readme"),
+        ]:
+            member = tarfile.TarInfo(f"owner-repo-0123456/{path}")
+            member.size = len(content)
+            archive.addfile(member, io.BytesIO(content))
+    archive_file.seek(0)
+    return archive_file
+
+
+def test_extract_directory(repo_tarball):
+    files = list(extract_directory(repo_tarball, "gcp"))
+
+    assert [(file_.name, file_.path) for file_ in files] == [
+        ("project.tf", "gcp/project.tf"),
+        ("main.tf", "gcp/modules/network/main.tf"),
+    ]
+    assert files[0].decoded_content == b"project"
+    assert files[0].sha == git_blob_digest(b"project")
+
+
+def test_fetch_directory_downloads_archive_once(mocker, repo_tarball):
+    session = mocker.patch("common.archive.get_http_session").return_value
+    session.get.return_value.raw = repo_tarball
+    repo = Mock()
+
+    files = fetch_directory(repo, "gcp", "master")
+
+    assert len(files) == 2
+    repo.get_archive_link.assert_called_once_with("tarball", "master")
+    session.get.assert_called_once()
+
+
+def test_fetch_directory_cached_downloads_missing_blobs(tmpdir, mocker):
+    cache = ContentStore(tmpdir.strpath, digest=git_blob_digest)
+    contents = {"gcp/project.tf": b"project", "gcp/vars.tf": b"vars"}
+    repo = Mock()
+    repo.get_git_tree.return_value.raw_data = {}
+    repo.get_git_tree.return_value.tree = [
+        Mock(
+            type="blob", mode="100644", path=path, sha=git_blob_digest(content)
+        )
+        for path, content in contents.items()
+    ] + [Mock(type="blob", mode="100644", path="aws/project.tf", sha="0" * 40)]
+    blobs = {
+        git_blob_digest(content): Mock(content=b64encode(content))
+        for content in contents.values()
+    }
+    repo.get_git_blob.side_effect = blobs.get
+    cache.put(b"project")
+
+    files = fetch_directory_cached(repo, "gcp", "master", cache)
+
+    assert {file_.path: file_.decoded_content for file_ in files} == contents
+    repo.get_git_blob.assert_called_once_with(git_blob_digest(b"vars"))
+
+    fetch_directory_cached(repo, "gcp", "master", cache)
+    repo.get_git_blob.assert_called_once()
+
+
+def test_fetch_directory_cached_uses_archive_for_many_missing_blobs(
+    tmpdir, mocker
+):
+    mocker.patch.dict(SETTINGS.attributes, {"GITHUB_BLOB_FETCH_LIMIT": 0})
+    archive_file = RepoFile("project.tf", "gcp/project.tf", b"project", "sha")
+    fetch_directory = mocker.patch(
+        "common.blobs.fetch_directory", return_value=[archive_file]
+    )
+    cache = ContentStore(tmpdir.strpath, digest=git_blob_digest)
+    repo = Mock()
+    repo.get_git_tree.return_value.raw_data = {}
+    repo.get_git_tree.return_value.tree = [
+        Mock(type="blob", mode="100644", path="gcp/project.tf", sha="sha")
+    ]
+
+    assert fetch_directory_cached(repo, "gcp", "master", cache) == [
+        archive_file
+    ]
+    fetch_directory.assert_called_once_with(repo, "gcp", "master")
+    repo.get_git_blob.assert_not_called()
+    assert cache.get(git_blob_digest(b"project")) == b"project"
+
+
+def test_fetch_directory_cached_uses_archive_for_truncated_tree(
+    tmpdir, mocker
+):
+    archive_file = RepoFile("project.tf", "gcp/project.tf", b"project", "sha")
+    fetch_directory = mocker.patch(
+        "common.blobs.fetch_directory", return_value=[archive_file]
+    )
+    cache = ContentStore(tmpdir.strpath, digest=git_blob_digest)
+    repo = Mock()
+    # listing of large repository is incomplete
+    repo.get_git_tree.return_value.raw_data = {"truncated": True}
+    repo.get_git_tree.return_value.tree = []
+
+    assert fetch_directory_cached(repo, "gcp", "master", cache) == [
+        archive_file
+    ]
+    fetch_directory.assert_called_once_with(repo, "gcp", "master")
+
+
+def test_https_connection_revalidates_cached_responses(tmpdir, mocker):
+    cache = ResponseCache(tmpdir.join("cache.sqlite").strpath, 10)
+    mocker.patch("common.http_cache.get_response_cache", return_value=cache)
+    session = mocker.patch("common.rate_limit.get_http_session").return_value
+    session.request.side_effect = [
+        Mock(status_code=200, headers={"ETag": '"v1"'}, text='{"id": 1}'),
+        Mock(status_code=304, headers={"X-RateLimit-Remaining": "10"}),
+    ]
+
+    def get():
+        connection = HTTPSConnection("api.github.com")
+        connection.request("GET", "/orgs/some-org", None, {"Accept": "json"})
+        return connection.getresponse()
+
+    first, second = get(), get()
+
+    assert (first.status, first.read()) == (200, '{"id": 1}')
+    assert (second.status, second.read()) == (200, '{"id": 1}')
+    assert dict(second.getheaders())["X-RateLimit-Remaining"] == "10"
+    assert session.request.call_args[1]["headers"]["If-None-Match"] == '"v1"'
+    assert cache.stats == {"hits": 1, "misses": 1, "hit_ratio": 0.5}
+
+
+def test_https_connection_shared_by_threads(mocker):
+    """
+    Every thread gets response to its own request, when threads interleave
+    on the same connection.
+    """
+    mocker.patch("common.http_cache.get_response_cache", return_value=None)
+    session = mocker.patch("common.rate_limit.get_http_session").return_value
+    session.request.side_effect = lambda verb, url, **kwargs: Mock(
+        status_code=200, headers={}, text=url
+    )
+    connection = HTTPSConnection("api.github.com")
+    both_requested = threading.Barrier(2)
+    responses = {}
+
+    def get(path):
+        connection.request("GET", path, None, {})
+        both_requested.wait(timeout=10)
+        responses[path] = connection.getresponse().read()
+
+    threads = [
+        threading.Thread(target=get, args=(path,))
+        for path in ("/repos/org/code", "/repos/org/config")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert responses == {
+        path: f"https://api.github.com:443{path}"
+        for path in ("/repos/org/code", "/repos/org/config")
+    }
+
+
+def test_response_cache_prunes_least_recently_used(tmpdir):
+    cache = ResponseCache(tmpdir.join("cache.sqlite").strpath, 1)
+    cache.store("old", '"v1"', None, {}, "old")
+    cache.store("new", '"v1"', None, {}, "new")
+
+    cache.prune()
+
+    assert cache.lookup("old") is None
+    assert cache.lookup("new").body == "new"
+
+
+def test_rate_limited_requests_are_retried(mocker):
+    session = mocker.patch("common.rate_limit.get_http_session").return_value
+    session.request.side_effect = [
+        Mock(status_code=429, headers={"Retry-After": "0"}),
+        Mock(status_code=403, headers={"X-RateLimit-Remaining": "1"}),
+    ]
+    limiter = rate_limit.RateLimiter(rate=100, burst=10)
+    mocker.patch("common.rate_limit.get_rate_limiter", return_value=limiter)
+
+    response = rate_limit.request("GET", "https://api.github.com/orgs/org")
+
+    # permission errors are not retried
+    assert response.status_code == 403
+    assert session.request.call_count == 2
+    assert limiter.stats["requests"] == 2
+    assert limiter.stats["retries"] == 1
+
+
+def test_rate_limiter_gives_fair_shares():
+    limiter = rate_limit.RateLimiter(rate=1000, burst=1)
+    limiter.acquire("busy-project")
+    limiter.pause(0.3)
+    granted = []
+
+    def acquire():
+        limiter.acquire(rate_limit.current_share())
+        granted.append(rate_limit.current_share())
+
+    threads = []
+    for project in ["busy-project"] * 3 + ["other-project"]:
+        with rate_limit.share(project):
+            threads.append(
+                threading.Thread(target=rate_limit.propagate(acquire))
+            )
+        threads[-1].start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+    # waiting since the last, but never served before
+    assert granted == ["other-project"] + ["busy-project"] * 3
+
+
+def test_rate_limiter_pauses_when_limit_is_exhausted():
+    limiter = rate_limit.RateLimiter(rate=1000, burst=10)
+    limiter.observe(
+        {
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset": str(time.time() + 0.5),
+        }
+    )
+
+    start = time.monotonic()
+    limiter.acquire()
+
+    assert time.monotonic() - start >= 0.5
+
+
+def test_mirror_reads_files_and_commits(tmpdir):
+    remote = tmpdir.join("remote")
+    os.makedirs(remote.join("gcp", "modules").strpath)
+    remote.join("gcp", "project.tf").write("project")
+    remote.join("gcp", "modules", "main.tf").write("module")
+    remote.join("README.md").write("readme")
+
+    def git(*args):
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "user.name=test",
+                "-c",
+                "user.email=test@test",
+                *args,
+            ],
+            cwd=remote.strpath,
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+
+    def head():
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=remote.strpath
+            )
+            .decode()
+            .strip()
+        )
+
+    git("init", "--quiet", "--initial-branch=master")
+    git("add", ".")
+    git("commit", "--quiet", "-m", "first")
+    first_commit = head()
+
+    mirror_path = tmpdir.join("mirrors", "remote.git").strpath
+    mirror = RepoMirror(mirror_path, "file://" + remote.strpath)
+
+    assert mirror.resolve("master") == first_commit
+    assert sorted(mirror.read_directory("master", "gcp")) == [
+        RepoFile(
+            "main.tf",
+            "gcp/modules/main.tf",
+            b"module",
+            git_blob_digest(b"module"),
+        ),
+        RepoFile(
+            "project.tf",
+            "gcp/project.tf",
+            b"project",
+            git_blob_digest(b"project"),
+        ),
+    ]
+
+    remote.join("gcp", "project.tf").write("changed")
+    git("commit", "--quiet", "-am", "second")
+
+    # fetched by the next run only
+    assert mirror.resolve("master") == first_commit
+    mirror = RepoMirror(mirror_path, "file://" + remote.strpath)
+    assert mirror.resolve("master") == head()
+    files = mirror.read_directory(first_commit, "gcp/")
+    assert b"project" in [file_.decoded_content for file_ in files]
+
+
+def test_mirror_token_is_passed_to_git(mocker, tmpdir):
+    mocker.patch.dict(
+        "settings.SETTINGS.attributes",
+        {"GITHUB_MIRROR_DIR": tmpdir.join("mirrors").strpath},
+    )
+    url = "https://github.com/some-org/some-repo.git"
+    mirror = get_mirror(url, "token")
+    other_mirror = get_mirror(url, "other-token")
+
+    assert mirror is get_mirror(url, "token")
+    assert other_mirror is not mirror
+    assert other_mirror.token == "other-token"
+    assert other_mirror.path == mirror.path
+
+    header = mirror._run(["config", "--get", "http.extraHeader"])
+    credentials = b64encode(b"x-access-token:token").decode()
+    assert header.decode().strip() == "Authorization: Basic " + credentials
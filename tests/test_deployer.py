@@ -1,22 +1,60 @@
 import os
+import re
+import json
+import sys
+from copy import copy, deepcopy
 
 from uuid import uuid4
 from itertools import chain
 from pathlib import Path
-from unittest.mock import Mock, PropertyMock, call
+from threading import Barrier, Event
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, Mock, PropertyMock, call
 
 import pytest
 
 from deployer import (
     deploy,
     assert_project_id_did_not_change,
-    _prepare_state_for_compare,
     WrongStateError,
+    NO_CHANGES,
+    _join,
+)
+from deployer.files import materialise
+from deployer.ledger import ValidationLedger
+from deployer.plugin_cache import PluginCache
+from deployer.pool import WorkingDirPool
+from deployer.runner import (
+    run_command,
+    CommandCancelledError,
+    CommandTimeoutError,
+)
+from deployer.state_cache import StateCache
+from deployer.state_diff import diff_states, index_state, Change
+from deployer.terraform import (
     TerraformDeployer,
     TerraformCommandError,
+    PLAN_HAS_CHANGES_RETURN_CODE,
 )
 
 
+@pytest.fixture
+def mock_deployers(mocker):
+    """
+    Patches `TerraformDeployer`, so it returns test or real deployment mock
+    depending on passed arguments, since deployers are created concurrently.
+    """
+
+    def patch(test_deployment, real_deployment):
+        deployer = mocker.patch("deployer.terraform.TerraformDeployer")
+        deployer.side_effect = lambda *args, **kwargs: (
+            test_deployment if len(args) == 4 else real_deployment
+        )
+        return deployer
+
+    return patch
+
+
 @pytest.fixture
 def terraform_deployer(
     mocker, working_directory, command_line_args, code_files, config_files
@@ -62,10 +100,59 @@ def test_command_throws_error(terraform_deployer):
     If terraform subprocess returns error code, we throw error with detailed info.
     """
     terraform_deployer.cmd = Mock(return_value=(1, "", ""))
+    terraform_deployer.state_cache.invalidate()
     with pytest.raises(TerraformCommandError):
         terraform_deployer.get_state()
 
 
+def test_run_command_streams_output():
+    """
+    Every line of output is logged, while only tail of it is kept.
+    """
+    logger = Mock()
+    script = "for i in range(10): print(i, flush=True)"
+
+    return_code, out, err = run_command(
+        [sys.executable, "-c", script], logger, tail_lines=3
+    )
+
+    assert (return_code, out, err) == (0, "7\n8\n9\n", "")
+    assert logger.info.call_count == 10
+
+    logger.reset_mock()
+    _, out, _ = run_command(
+        [sys.executable, "-c", script], logger, capture_stdout=True
+    )
+    assert out.split() == [str(i) for i in range(10)]
+    # captured output, like state, could contain secrets
+    logger.info.assert_not_called()
+
+
+SLEEPING_SCRIPT = "import time; print('started', flush=True); time.sleep(30)"
+
+
+def test_run_command_timeout():
+    with pytest.raises(CommandTimeoutError) as error:
+        run_command(
+            [sys.executable, "-c", SLEEPING_SCRIPT],
+            Mock(),
+            timeout=0.5,
+        )
+    assert "started" in error.value.out
+
+
+def test_run_command_cancellation():
+    cancellation = Event()
+    cancellation.set()
+
+    with pytest.raises(CommandCancelledError):
+        run_command(
+            [sys.executable, "-c", SLEEPING_SCRIPT],
+            Mock(),
+            cancellation=cancellation,
+        )
+
+
 def test_get_state(terraform_deployer):
     """
     Initial state should be empty.
@@ -76,20 +163,20 @@ def test_get_state(terraform_deployer):
 @pytest.mark.usefixtures("google_credentials")
 def test_create_plan(terraform_deployer):
     """
-    Tests, that create_plan method creates plan file in project dir.
+    Tests, that create_plan method creates plan file in working dir.
     """
     terraform_deployer.create_plan()
-    assert os.path.exists(terraform_deployer.project_dir / "plan")
+    assert os.path.exists(terraform_deployer.working_dir / "plan")
 
 
 def test_create_destroy_plan(terraform_deployer):
     """
-    Tests, that create_plan method with destroy option creates plan file in project dir.
+    Tests, that create_plan method with destroy option creates plan file in working dir.
     """
     terraform_deployer.command = Mock(side_effect=terraform_deployer.command)
     terraform_deployer.create_plan(destroy=True)
     assert "-destroy" in terraform_deployer.command.call_args[0][0]
-    assert os.path.exists(terraform_deployer.project_dir / "destroy_plan")
+    assert os.path.exists(terraform_deployer.working_dir / "destroy_plan")
 
 
 def test_run_changes_state(terraform_deployer):
@@ -123,17 +210,149 @@ def test_delete(terraform_deployer):
     terraform_deployer.run = Mock()
     terraform_deployer.delete()
     terraform_deployer.run.assert_called_with(
-        terraform_deployer.project_dir / "destroy_plan"
+        terraform_deployer.working_dir / "destroy_plan"
+    )
+
+
+def test_clouds_apply_own_plans(
+    mocker, working_directory, command_line_args, code_files, config_files
+):
+    """
+    Deployers of the same project for different clouds run concurrently, so
+    every one of them should apply the plan it created.
+    """
+    mocker.patch.dict(
+        "settings.SETTINGS.attributes",
+        {"WORKING_DIR_BASE": Path(working_directory.strpath)},
+    )
+    for method in ("_initialise", "_create_workspace", "get_state"):
+        mocker.patch.object(TerraformDeployer, method)
+    applied_plans = {}
+
+    def command(deployer, command, *args, **kwargs):
+        cloud = deployer.working_dir.name
+        if command.startswith("plan"):
+            plan_path = re.search(r"-out=(\S+)", command).group(1)
+            Path(plan_path).write_text(cloud)
+            return PLAN_HAS_CHANGES_RETURN_CODE, "", ""
+        applied_plans[cloud] = Path(command.split()[-1]).read_text()
+        return 0, "", ""
+
+    mocker.patch.object(
+        TerraformDeployer, "command", autospec=True, side_effect=command
     )
+    both_planned = Barrier(2)
+
+    def deploy_cloud(cloud):
+        args = copy(command_line_args)
+        args.cloud = cloud
+        deployer = TerraformDeployer(args, code_files, config_files)
+        plan = deployer.create_plan()
+        both_planned.wait(timeout=10)
+        deployer.run(plan)
 
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(deploy_cloud, ["gcp", "aws"]))
 
-def test_prepare_state_for_compare(project_state1, project_state2):
+    assert applied_plans == {"gcp": "gcp", "aws": "aws"}
+
+
+def test_state_cache(project_state1):
     """
-    Tests that states being cleaned properly.
+    Cached state is returned until it's invalidated or state file changes,
+    and pulled state with the same serial and lineage is not parsed again.
     """
-    assert _prepare_state_for_compare(
-        project_state1
-    ) == _prepare_state_for_compare(project_state2)
+    state_cache = StateCache()
+    pulled_state = json.dumps(project_state1)
+    fingerprint = (1, 1)
+    assert state_cache.get(fingerprint) is None
+
+    state = state_cache.update(pulled_state, fingerprint)
+    assert state == project_state1
+    assert state_cache.get(fingerprint) is state
+    assert state_cache.get((1, 2)) is None
+
+    state_cache.invalidate_after("plan -input=false")
+    assert state_cache.get(fingerprint) is state
+    state_cache.invalidate_after("apply -input=false plan")
+    assert state_cache.get(fingerprint) is None
+
+    assert state_cache.update(pulled_state, fingerprint) is state
+
+    project_state1["serial"] += 1
+    changed_state = state_cache.update(json.dumps(project_state1), fingerprint)
+    assert changed_state is not state
+
+
+def test_state_cache_misses_without_fingerprint(project_state1):
+    """
+    State of remote backend has no fingerprint, so it's pulled every time,
+    but not parsed again, while its serial and lineage are the same.
+    """
+    state_cache = StateCache()
+    pulled_state = json.dumps(project_state1)
+
+    state = state_cache.update(pulled_state, None)
+    assert state_cache.get(None) is None
+    assert state_cache.update(pulled_state, None) is state
+
+
+def test_index_state_is_cached_read_only(project_state1):
+    """
+    Index of state is reused for equal state, so it can't be modified by
+    one of its users.
+    """
+    index = index_state(project_state1)
+    with pytest.raises(TypeError):
+        index["globals"] = "changed"
+
+    same_index = index_state(deepcopy(project_state1))
+    assert same_index is index
+    assert same_index["globals"] != "changed"
+
+
+def test_diff_states_ignores_unique_attributes(project_state1, project_state2):
+    """
+    Tests that unique attributes of deployments are not compared.
+    """
+    assert diff_states(project_state1, project_state2).equal
+
+
+def test_diff_states_reports_changed_resources(project_state1, project_state2):
+    """
+    Diff contains only addresses and attribute names of changed instances.
+    """
+    project_attributes = project_state2["resources"][0]["instances"][0][
+        "attributes"
+    ]
+    project_attributes["billing_account"] = str(uuid4())
+    project_state2["resources"].pop()
+    project_state2["serial"] += 1
+
+    state_diff = diff_states(project_state1, project_state2)
+
+    assert not state_diff.equal
+    assert state_diff.changes == [
+        Change("google_project.project", "changed", ("billing_account",)),
+        Change("google_project_services.project", "removed", ()),
+    ]
+    assert str(state_diff) == (
+        "changed: google_project.project (billing_account)\n"
+        "removed: google_project_services.project"
+    )
+
+
+def test_diff_states_is_bounded(project_state1):
+    """
+    Report contains limited number of changes, while all of them are counted.
+    """
+    real_state = {"resources": []}
+
+    state_diff = diff_states(project_state1, real_state, max_changes=1)
+
+    assert state_diff.total == 3
+    assert len(state_diff.changes) == 1
+    assert str(state_diff).endswith("... and 2 more")
 
 
 def test_assert_project_id_did_not_change(project_state1):
@@ -146,7 +365,11 @@ def test_assert_project_id_did_not_change(project_state1):
 
 
 def test_deploy(
-    mocker, command_line_args, code_files, config_files, short_code_config_hash
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    short_code_config_hash,
 ):
     """
     Checks, that when `deploy` being called:
@@ -172,8 +395,7 @@ def test_deploy(
         ]
     )
 
-    deployer = mocker.patch("deployer.TerraformDeployer")
-    deployer.side_effect = [test_deployment, real_deployment]
+    deployer = mock_deployers(test_deployment, real_deployment)
 
     deploy(command_line_args, code_files, config_files, short_code_config_hash)
 
@@ -184,14 +406,200 @@ def test_deploy(
                 code_files,
                 config_files,
                 short_code_config_hash,
+                code_hash=None,
+                cancellation=ANY,
+            ),
+            call(
+                command_line_args,
+                code_files,
+                config_files,
+                code_hash=None,
+                cancellation=ANY,
             ),
-            call(command_line_args, code_files, config_files),
+        ],
+        any_order=True,
+    )
+
+    test_deployment.run.assert_called_once_with(
+        test_deployment.create_plan.return_value
+    )
+    test_deployment.delete.assert_called_once()
+    real_deployment.run.assert_called_once_with(
+        real_deployment.create_plan.return_value
+    )
+
+
+def test_deploy_no_changes(
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    short_code_config_hash,
+):
+    """
+    When plan of real deployment has no changes, neither test nor real
+    deployment is applied.
+    """
+    test_deployment = Mock()
+    real_deployment = Mock()
+    real_deployment.has_changes.return_value = False
+    mock_deployers(test_deployment, real_deployment)
+
+    result = deploy(
+        command_line_args, code_files, config_files, short_code_config_hash
+    )
+
+    assert result == NO_CHANGES
+    real_deployment.has_changes.assert_called_once_with(
+        real_deployment.create_plan.return_value
+    )
+    test_deployment.run.assert_not_called()
+    test_deployment.delete.assert_not_called()
+    real_deployment.run.assert_not_called()
+
+
+def test_deploy_test_branch_failure(
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    short_code_config_hash,
+):
+    """
+    Failure of test deployment should be raised in caller thread and real
+    deployment should never be applied.
+    """
+    test_deployment = Mock()
+    real_deployment = Mock()
+    test_deployment.run.side_effect = TerraformCommandError(
+        1, "apply", "", "error"
+    )
+    mock_deployers(test_deployment, real_deployment)
+
+    with pytest.raises(TerraformCommandError):
+        deploy(
+            command_line_args, code_files, config_files, short_code_config_hash
+        )
+
+    real_deployment.run.assert_not_called()
+    test_deployment.delete.assert_not_called()
+
+
+def test_join_cancels_running_commands():
+    """
+    Failure of one branch sets cancellation event, which stops terraform
+    commands of another one.
+    """
+    cancellation = Event()
+
+    def fail():
+        raise WrongStateError("failed")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        running = executor.submit(cancellation.wait, 5)
+        failed = executor.submit(fail)
+        with pytest.raises(WrongStateError):
+            _join(running, failed, cancellation=cancellation)
+
+    assert running.result() is True
+
+
+def test_deploy_real_branch_failure(
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    short_code_config_hash,
+):
+    """
+    Failure during initialisation of real deployment should be raised in
+    caller thread, while test deployment should not be verified nor deleted.
+    """
+    test_deployment = Mock()
+    real_deployment = Mock()
+    real_deployment.create_plan.side_effect = TerraformCommandError(
+        1, "plan", "", "error"
+    )
+    mock_deployers(test_deployment, real_deployment)
+
+    with pytest.raises(TerraformCommandError):
+        deploy(
+            command_line_args, code_files, config_files, short_code_config_hash
+        )
+
+    real_deployment.run.assert_not_called()
+    test_deployment.delete.assert_not_called()
+
+
+def test_deploy_validated(
+    mocker,
+    tmpdir,
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    short_code_config_hash,
+    sha256_hash,
+):
+    """
+    Successful deployment is recorded in ledger, so next deployment of the same
+    code and config skips test deployment.
+    """
+    ledger = ValidationLedger(tmpdir.join("ledger.sqlite").strpath, ttl=60)
+    mocker.patch("deployer.get_validation_ledger", return_value=ledger)
+    test_deployment = Mock()
+    real_deployment = Mock()
+    test_deployment.current_state = {"serial": 1, "some_key": 123}
+    type(real_deployment).current_state = PropertyMock(
+        side_effect=[
+            {},
+            {"serial": 2, "some_key": 123},
+            {"serial": 2, "some_key": 123},
+            {"serial": 3, "some_key": 123},
         ]
     )
+    deployer = mock_deployers(test_deployment, real_deployment)
+    arguments = (
+        command_line_args,
+        code_files,
+        config_files,
+        short_code_config_hash,
+        sha256_hash,
+        sha256_hash,
+    )
 
+    deploy(*arguments)
+    assert ledger.is_validated(sha256_hash, sha256_hash, "gcp")
+    assert deployer.call_count == 2
+
+    deploy(*arguments)
+    assert deployer.call_count == 3
+    deployer.assert_called_with(
+        command_line_args,
+        code_files,
+        config_files,
+        code_hash=sha256_hash,
+        cancellation=ANY,
+    )
     test_deployment.run.assert_called_once()
-    test_deployment.delete.assert_called_once()
-    real_deployment.run.assert_called_once()
+    assert real_deployment.run.call_count == 2
+
+
+def test_validation_ledger(tmpdir, sha256_hash):
+    ledger = ValidationLedger(tmpdir.join("ledger.sqlite").strpath, ttl=60)
+    assert not ledger.is_validated(sha256_hash, sha256_hash, "gcp")
+
+    ledger.record(sha256_hash, sha256_hash, "gcp")
+    ledger.record(sha256_hash, sha256_hash, "aws")
+    assert ledger.is_validated(sha256_hash, sha256_hash, "gcp")
+    assert not ledger.is_validated(sha256_hash, str(uuid4()), "gcp")
+
+    ledger.invalidate(cloud="gcp")
+    assert not ledger.is_validated(sha256_hash, sha256_hash, "gcp")
+    assert ledger.is_validated(sha256_hash, sha256_hash, "aws")
+
+    ledger.ttl = 0
+    assert not ledger.is_validated(sha256_hash, sha256_hash, "aws")
 
 
 @pytest.mark.parametrize(
@@ -212,7 +620,12 @@ def test_deploy(
     ],
 )
 def test_deploy_different_states(
-    mocker, command_line_args, code_files, config_files, test_state, real_state
+    mock_deployers,
+    command_line_args,
+    code_files,
+    config_files,
+    test_state,
+    real_state,
 ):
     """
     Checks that wrong state leads to wrong state error.
@@ -226,8 +639,152 @@ def test_deploy_different_states(
     test_deployment.current_state = test_state
     real_deployment.current_state = real_state
 
-    deployer = mocker.patch("deployer.TerraformDeployer")
-    deployer.side_effect = [test_deployment, real_deployment]
+    mock_deployers(test_deployment, real_deployment)
 
     with pytest.raises(WrongStateError):
         deploy(command_line_args, code_files, config_files)
+
+
+def test_plugin_cache_restores_saved_files(tmpdir):
+    """
+    Providers and modules saved from one working directory are linked into
+    another one with the same code, and counted as cache hits.
+    """
+    cache = PluginCache(tmpdir.join("cache").strpath)
+    source = Path(tmpdir.join("source").strpath)
+    plugin = source / ".terraform/plugins/linux_amd64/terraform-provider-google"
+    module = source / ".terraform/modules/modules.json"
+    for path, content in ((plugin, b"provider"), (module, b"{}")):
+        os.makedirs(path.parent)
+        path.write_bytes(content)
+
+    cache.save(source, "code-digest")
+    assert cache.stats == {"hits": 0, "misses": 2}
+
+    destination = Path(tmpdir.join("destination").strpath)
+    cache.restore(destination, "code-digest")
+
+    assert (destination / plugin.relative_to(source)).read_bytes() == (
+        b"provider"
+    )
+    assert (destination / module.relative_to(source)).read_bytes() == b"{}"
+    assert cache.stats == {"hits": 2, "misses": 2}
+
+    other_destination = Path(tmpdir.join("other").strpath)
+    cache.restore(other_destination, "other-code-digest")
+    assert not (other_destination / module.relative_to(source)).exists()
+    # other code could require other providers
+    assert not (other_destination / plugin.relative_to(source)).exists()
+    assert cache.stats == {"hits": 2, "misses": 2}
+
+
+def test_working_dir_pool(tmpdir, sha256_hash):
+    """
+    Initialised terraform directory is cloned without workspace selection,
+    and evicted when pool exceeds its size.
+    """
+    pool = WorkingDirPool(tmpdir.join("pool").strpath, size=1)
+    working_dir = Path(tmpdir.join("project/gcp").strpath)
+    os.makedirs(working_dir / ".terraform/modules")
+    (working_dir / ".terraform/environment").write_text("project")
+    (working_dir / ".terraform/modules/modules.json").write_text("{}")
+    (working_dir / "project_settings.auto.tfvars.json").write_text("{}")
+
+    assert not pool.claim(sha256_hash, "gcp", working_dir)
+    pool.add(sha256_hash, "gcp", working_dir)
+
+    claimed_dir = Path(tmpdir.join("other_project/gcp").strpath)
+    assert pool.claim(sha256_hash, "gcp", claimed_dir)
+    assert os.listdir(claimed_dir) == [".terraform"]
+    assert (claimed_dir / ".terraform/modules/modules.json").exists()
+    assert not (claimed_dir / ".terraform/environment").exists()
+
+    pool.add(str(uuid4()), "gcp", working_dir)
+    assert not pool.claim(sha256_hash, "gcp", Path(tmpdir.join("new").strpath))
+
+
+def test_failed_init_is_not_pooled(
+    mocker, tmpdir, command_line_args, code_files, config_files, sha256_hash
+):
+    """
+    Directory, where `terraform init` failed, could miss providers or
+    modules, so it's neither pooled, nor cached.
+    """
+    pool = WorkingDirPool(tmpdir.join("pool").strpath, size=1)
+    mocker.patch("deployer.terraform.get_working_dir_pool", return_value=pool)
+    plugin_cache = mocker.patch("deployer.terraform.get_plugin_cache").return_value
+    mocker.patch.dict(
+        "settings.SETTINGS.attributes",
+        {"WORKING_DIR_BASE": Path(tmpdir.join("projects").strpath)},
+    )
+    mocker.patch("deployer.terraform.run_command", return_value=(1, "", "no network"))
+
+    with pytest.raises(TerraformCommandError):
+        TerraformDeployer(
+            command_line_args, code_files, config_files, code_hash=sha256_hash
+        )
+
+    plugin_cache.save.assert_not_called()
+    assert not pool.path(sha256_hash, command_line_args.cloud).exists()
+
+
+def test_broken_claimed_dir_is_removed_from_pool(
+    mocker, tmpdir, command_line_args, code_files, config_files, sha256_hash
+):
+    """
+    Directory cloned from pool, which turns out to be not initialised, is
+    removed from the pool, so next deploy runs `terraform init` again.
+    """
+    pool = WorkingDirPool(tmpdir.join("pool").strpath, size=1)
+    initialised_dir = Path(tmpdir.join("initialised").strpath)
+    os.makedirs(initialised_dir / ".terraform")
+    pool.add(sha256_hash, command_line_args.cloud, initialised_dir)
+    mocker.patch("deployer.terraform.get_working_dir_pool", return_value=pool)
+    mocker.patch.dict(
+        "settings.SETTINGS.attributes",
+        {"WORKING_DIR_BASE": Path(tmpdir.join("projects").strpath)},
+    )
+    initialise = mocker.patch.object(TerraformDeployer, "_initialise")
+    mocker.patch(
+        "deployer.terraform.run_command",
+        return_value=(1, "", 'Please run "terraform init".'),
+    )
+
+    with pytest.raises(TerraformCommandError):
+        TerraformDeployer(
+            command_line_args, code_files, config_files, code_hash=sha256_hash
+        )
+
+    initialise.assert_not_called()
+    assert not pool.path(sha256_hash, command_line_args.cloud).exists()
+    working_dir = (
+        Path(tmpdir.join("projects").strpath)
+        / command_line_args.project_id
+        / command_line_args.cloud
+    )
+    assert not pool.claim(sha256_hash, command_line_args.cloud, working_dir)
+
+
+def test_materialise_writes_only_changed_files(
+    tmpdir, code_files, config_files, github_file_factory
+):
+    """
+    Files with unchanged content are not rewritten, while removed files are
+    deleted from the project directory.
+    """
+    project_dir = Path(tmpdir.strpath)
+    files = code_files + config_files
+
+    assert materialise(project_dir, files, "gcp") == [
+        file_.path for file_ in files
+    ]
+    assert materialise(project_dir, files, "gcp") == []
+
+    changed_file = github_file_factory(
+        code_files[0].name, code_files[0].path, b"# changed"
+    )
+    assert materialise(project_dir, [changed_file], "gcp") == [
+        changed_file.path
+    ] + sorted(file_.path for file_ in config_files)
+    assert (project_dir / changed_file.path).read_bytes() == b"# changed"
+    assert not (project_dir / config_files[0].path).exists()
@@ -0,0 +1,110 @@
+import json
+from threading import Thread
+from unittest.mock import Mock
+
+import pytest
+
+from reporter import tracing
+from reporter.stackdriver import AppMetrics, MAX_TIME_SERIES_PER_REQUEST
+
+
+@pytest.fixture
+def recorder():
+    logger = Mock()
+    yield tracing.enable(logger)
+    tracing.disable()
+
+
+def test_nested_spans(recorder):
+    with tracing.span("deploy", project="some-project"):
+        with tracing.span("plan", deployment="test"):
+            pass
+        with tracing.span("plan", deployment="test"):
+            pass
+
+    paths = [(span.path, span.labels) for span in recorder.spans]
+    assert paths == [
+        ("deploy/plan", {"project": "some-project", "deployment": "test"}),
+        ("deploy/plan", {"project": "some-project", "deployment": "test"}),
+        ("deploy", {"project": "some-project"}),
+    ]
+
+    logged = json.loads(recorder._log.info.call_args_list[0][0][0])
+    assert logged["phase"] == "deploy/plan"
+    assert logged["deployment"] == "test"
+
+    metrics = recorder.metrics(max_depth=2)
+    assert [metric["labels"]["phase"] for metric in metrics] == [
+        "deploy/plan",
+        "deploy",
+    ]
+    assert recorder.metrics(max_depth=1)[0]["labels"] == {
+        "phase": "deploy",
+        "project": "some-project",
+    }
+
+
+def test_span_propagates_to_another_thread(recorder):
+    def plan():
+        with tracing.span("plan"):
+            pass
+
+    with tracing.span("deploy"):
+        thread = Thread(target=tracing.propagate(plan))
+        thread.start()
+        thread.join()
+
+    assert [span.path for span in recorder.spans] == ["deploy/plan", "deploy"]
+
+
+def test_disabled_span_records_nothing():
+    tracing.disable()
+
+    with tracing.span("deploy") as span:
+        assert span is tracing.span("plan")
+
+
+def test_metrics_aggregated_across_projects(recorder):
+    for project in ("first-project", "second-project"):
+        with tracing.span("deploy", project=project, cloud="gcp"):
+            pass
+
+    metrics = recorder.metrics(aggregated_labels=("project",))
+
+    assert len(metrics) == 1
+    assert metrics[0]["labels"] == {"phase": "deploy", "cloud": "gcp"}
+    assert metrics[0]["value"] == sum(span.duration for span in recorder.spans)
+
+
+def test_app_metrics_sent_in_batches(mocker):
+    mocker.patch("reporter.stackdriver.sleep")
+    mocker.patch.object(
+        AppMetrics,
+        "add_data_points_to_metric_message",
+        side_effect=lambda message, value: message,
+    )
+    client = Mock()
+    app_metrics = AppMetrics(
+        monitoring_project="some-project",
+        monitoring_credentials=None,
+        metrics_client=client,
+    )
+    app_metrics.metrics_set_list = [
+        {
+            "metric_name": f"metric_{index % 2}",
+            "labels": {"index": str(index)},
+            "metric_kind": "gauge",
+            "value_type": "double",
+            "value": 1.0,
+        }
+        for index in range(MAX_TIME_SERIES_PER_REQUEST + 50)
+    ]
+
+    app_metrics.send_metrics()
+
+    metrics_client = client.return_value
+    assert metrics_client.create_metric_descriptor.call_count == 2
+    assert [
+        len(series)
+        for (_, series), _ in metrics_client.create_time_series.call_args_list
+    ] == [MAX_TIME_SERIES_PER_REQUEST, 50]
@@ -0,0 +1,27 @@
+from scheduler import run_concurrently, format_summary
+
+
+def test_run_concurrently_records_failures():
+    def fail():
+        raise ValueError("some error")
+
+    results = run_concurrently([("first", lambda: 1), ("second", fail)], 2)
+
+    assert [task_result.name for task_result in results] == ["first", "second"]
+    assert results[0].result == 1 and results[0].error is None
+    assert isinstance(results[1].error, ValueError)
+
+
+def test_format_summary():
+    results = run_concurrently(
+        [("first", lambda: True), ("second", lambda: 1 / 0)], 1
+    )
+
+    summary = format_summary(results, lambda result: "success")
+
+    lines = summary.splitlines()
+    assert lines[0].split() == ["NAME", "RESULT", "TIME,", "S", "ERROR"]
+    assert lines[1].split()[:2] == ["first", "success"]
+    assert lines[2].split()[:2] == ["second", "failure"]
+    assert "ZeroDivisionError" in lines[2]
+    assert lines[-1] == "2 total, 1 failed"
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+
+from unittest.mock import Mock
+
+import pytest
+
+from settings import SETTINGS, Settings
+from settings.lazy import LazySetting
+
+# modules, which are slow to import, and should be imported only when command
+# needs them
+DEFERRED_MODULES = (
+    "github",
+    "requests",
+    "httplib2",
+    "google.cloud.monitoring_v3",
+    "google.protobuf",
+    "python_terraform",
+)
+
+# generous limit of cumulative import time, seconds
+IMPORT_TIME_BUDGET = 0.5
+
+
+def import_times(module):
+    """
+    Imports module in a fresh interpreter.
+    :return: dict: cumulative import time of every imported module, seconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SETTINGS.MODULE_ROOT_DIR,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 10 ** 6
+    return times
+
+
+def is_deferred(name):
+    return any(
+        name == deferred or name.startswith(deferred + ".")
+        for deferred in DEFERRED_MODULES
+    )
+
+
+@pytest.mark.parametrize(
+    "module", ["cloud_control", "settings", "deployer", "code_control"]
+)
+def test_startup_imports(module):
+    times = import_times(module)
+
+    slowest = sorted(times.items(), key=lambda item: item[1])[-10:]
+    report = "\n".join(f"{name}: {time:.3f}s" for name, time in slowest)
+    assert not [name for name in times if is_deferred(name)], report
+    assert times[module] < IMPORT_TIME_BUDGET, report
+
+
+def test_lazy_setting_is_resolved_once():
+    read_token = Mock(return_value="token")
+    settings = Settings(attributes={"TOKEN": LazySetting(read_token)})
+
+    read_token.assert_not_called()
+    assert settings.TOKEN == "token"
+    assert settings.get("TOKEN") == "token"
+    read_token.assert_called_once()